@@ -0,0 +1,308 @@
+#! /usr/bin/env python3
+
+"""
+The benchmark module measures the time and peak memory of the main
+operations of wagoner (building tables and trees, computing weighted choices
+and generating words) on seeded synthetic word lists, and saves the results
+so that two runs can be compared.
+
+Run it from the root of the repository with, for example:
+
+    python benchmarks/benchmark.py --output before.json
+    python benchmarks/benchmark.py --output after.json --compare before.json
+"""
+
+from __future__ import division, print_function
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wagoner.table import Table
+from wagoner.tree import Tree
+from wagoner.utils import natural, nonzero_natural
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+ALPHABETS = {
+    "small": "aeiost",
+    "latin": "abcdefghijklmnopqrstuvwxyz",
+    "large": "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+}
+
+
+def synthetic_words(count, alphabet, seed):
+    """
+    Return a list of count random words over alphabet.
+
+    :param count: the number of words;
+    :param alphabet: the characters of the words;
+    :param seed: the seed of the generation;
+    :return: the list of words.
+
+    The characters follow a random first-order Markov chain with skewed
+    weights, and the lengths of the words are between 2 and 14, such that
+    the words share sub-words like the words of a real text.
+    """
+    generator = random.Random(seed)
+    weights = {character: [generator.paretovariate(1) for _ in alphabet]
+               for character in alphabet + ">"}
+    words = []
+    for _ in range(count):
+        length = min(max(int(generator.gauss(7, 3)), 2), 14)
+        character = ">"
+        word = ""
+        for _ in range(length):
+            character = _weighted_choice(generator, alphabet,
+                                         weights[character])
+            word += character
+        words.append(word)
+    return words
+
+
+def _weighted_choice(generator, choices, weights):
+    """
+    Return a random element of choices, weighted by weights.
+    """
+    x = generator.random() * sum(weights)
+    for choice, weight in zip(choices, weights):
+        x -= weight
+        if x < 0:
+            return choice
+    return choices[-1]
+
+
+def measure(function, repeat, setup=None):
+    """
+    Return the time and peak memory taken by function.
+
+    :param function: a function without argument;
+    :param repeat: the number of timed calls; the best time is kept;
+    :param setup: if not None, a function without argument called (and not
+                  measured) before each call of function;
+    :return: a (seconds, peak, result) triple, where seconds is the best
+             time of the calls, peak the peak memory allocated by one call (in
+             bytes, None if it cannot be measured) and result the result of
+             the last call.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = timeit.default_timer()
+        result = function()
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if tracemalloc is not None:
+        # Memory is measured separately, as tracing slows down the calls
+        result = None
+        if setup is not None:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def run(sizes, alphabets, prefixes, lengths, calls, repeat, seed,
+        verbose=True):
+    """
+    Run the benchmarks and return their results.
+
+    :param sizes: the numbers of words of the word lists;
+    :param alphabets: the names of the alphabets of the word lists;
+    :param prefixes: the prefixes of the tables and trees;
+    :param lengths: the lengths of the generated words and trees;
+    :param calls: the number of calls of the per-word operations;
+    :param repeat: the number of timed runs of each operation;
+    :param seed: the seed of the word lists and of the generation;
+    :param verbose: whether to print the results as they are measured;
+    :return: a list of results, each result being a dictionary describing
+             the operation, its settings, its time and its peak memory.
+    """
+    results = []
+
+    def record(operation, settings, function, setup=None):
+        random.seed(seed)
+        seconds, peak, result = measure(function, repeat, setup=setup)
+        entry = dict(settings, operation=operation, seconds=seconds,
+                     peak_bytes=peak)
+        results.append(entry)
+        if verbose:
+            print(format_result(entry))
+        return result
+
+    for alphabet in alphabets:
+        for size in sizes:
+            words = synthetic_words(size, ALPHABETS[alphabet], seed)
+            contexts = [word[:len(word) // 2 + 1] for word in words[:calls]]
+            for prefix in prefixes:
+                for flatten in (False, True):
+                    settings = {"alphabet": alphabet, "words": size,
+                                "prefix": prefix, "flatten": flatten}
+                    table = record("table.from_words", settings,
+                                   lambda: Table.from_words(
+                                       words, prefix=prefix, flatten=flatten))
+                    record("table.weighted_choices", settings,
+                           lambda: [table.weighted_choices(context)
+                                    for context in contexts])
+                    # Generation is measured with empty caches
+                    setup = table._reset_caches
+                    for length in lengths:
+                        settings["length"] = length
+                        for name, start, end in (("", False, False),
+                                                 ("[start]", True, False),
+                                                 ("[end]", False, True)):
+                            record("table.random_word" + name, settings,
+                                   lambda: [table.random_word(
+                                       length, prefix=prefix, start=start,
+                                       end=end) for _ in range(calls)],
+                                   setup=setup)
+                        if prefix == 0:
+                            # Trees without prefix are too large to benchmark
+                            del settings["length"]
+                            continue
+                        tree = record("tree.from_table", settings,
+                                      lambda: Tree.from_table(
+                                          table, length, prefix=prefix))
+                        content = {node: dict(successors)
+                                   for node, successors in tree.items()}
+                        record("tree.trim_tree", settings,
+                               lambda: Tree.trim_tree(content))
+                        record("tree.random_word", settings,
+                               lambda: [tree.random_word()
+                                        for _ in range(calls)])
+                        del settings["length"]
+    return results
+
+
+def _key(entry):
+    """
+    Return the key identifying the operation and settings of a result.
+    """
+    return (entry["operation"], entry["alphabet"], entry["words"],
+            entry["prefix"], entry["flatten"], entry.get("length"))
+
+
+def format_result(entry, baseline=None):
+    """
+    Return a line describing the given result.
+
+    :param entry: the result;
+    :param baseline: if not None, the result of the same operation in another
+                     run, to compare with;
+    :return: the description of entry.
+    """
+    line = ("%-26s %-6s %7d words  prefix=%d  flatten=%-5s  length=%-4s  "
+            "%9.4fs" % (entry["operation"], entry["alphabet"], entry["words"],
+                        entry["prefix"], entry["flatten"],
+                        entry.get("length", "-"), entry["seconds"]))
+    if entry["peak_bytes"] is not None:
+        line += "  %9.2fMB" % (entry["peak_bytes"] / 2 ** 20)
+    if baseline is not None:
+        line += "  time x%.2f" % (entry["seconds"] / baseline["seconds"]
+                                  if baseline["seconds"] else float("inf"))
+        if entry["peak_bytes"] and baseline["peak_bytes"]:
+            line += "  memory x%.2f" % (entry["peak_bytes"] /
+                                        baseline["peak_bytes"])
+    return line
+
+
+def compare(results, baseline):
+    """
+    Print the comparison of results with the results of a baseline run.
+
+    :param results: the results of this run;
+    :param baseline: the results of the baseline run.
+    """
+    previous = {_key(entry): entry for entry in baseline}
+    print("Comparison with the baseline (ratios of this run over the "
+          "baseline):")
+    for entry in results:
+        if _key(entry) in previous:
+            print(format_result(entry, previous[_key(entry)]))
+
+
+def process_arguments():
+    """
+    Process the command line arguments. The arguments are:
+     * -w (or --words) the sizes of the word lists (default: 1000 10000);
+     * -a (or --alphabets) the alphabets of the word lists
+       (default: small latin);
+     * -p (or --prefixes) the prefixes of tables and trees (default: 0 2 3);
+     * -l (or --lengths) the lengths of words and trees (default: 6 10);
+     * -n (or --calls) the number of calls of per-word operations
+       (default: 200);
+     * -r (or --repeat) the number of timed runs of each operation
+       (default: 3);
+     * -s (or --seed) the seed of the word lists and generation (default: 0);
+     * -o (or --output) the file to save the results to, as JSON;
+     * -c (or --compare) a file of results of a previous run to compare with.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark wagoner on "
+                                                 "synthetic word lists")
+    parser.add_argument("--words", "-w", type=nonzero_natural, nargs="+",
+                        default=[1000, 10000], dest="sizes",
+                        help="the sizes of the word lists "
+                             "(default: 1000 10000)")
+    parser.add_argument("--alphabets", "-a", choices=sorted(ALPHABETS),
+                        nargs="+", default=["small", "latin"],
+                        dest="alphabets", help="the alphabets of the word "
+                                               "lists (default: small latin)")
+    parser.add_argument("--prefixes", "-p", type=natural, nargs="+",
+                        default=[0, 2, 3], dest="prefixes",
+                        help="the prefixes of the tables and trees "
+                             "(default: 0 2 3)")
+    parser.add_argument("--lengths", "-l", type=nonzero_natural, nargs="+",
+                        default=[6, 10], dest="lengths",
+                        help="the lengths of the generated words and trees "
+                             "(default: 6 10)")
+    parser.add_argument("--calls", "-n", type=nonzero_natural, default=200,
+                        dest="calls", help="the number of calls of per-word "
+                                           "operations (default: 200)")
+    parser.add_argument("--repeat", "-r", type=nonzero_natural, default=3,
+                        dest="repeat", help="the number of timed runs of "
+                                            "each operation (default: 3)")
+    parser.add_argument("--seed", "-s", type=natural, default=0,
+                        dest="seed", help="the seed of the word lists and "
+                                          "generation (default: 0)")
+    parser.add_argument("--output", "-o", type=argparse.FileType('w'),
+                        default=None, dest="output",
+                        help="the file to save the results to, as JSON")
+    parser.add_argument("--compare", "-c", type=argparse.FileType('r'),
+                        default=None, dest="compare",
+                        help="a file of results of a previous run to "
+                             "compare with")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = process_arguments()
+    results = run(args.sizes, args.alphabets, args.prefixes, args.lengths,
+                  args.calls, args.repeat, args.seed)
+    if args.output:
+        json.dump({"python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "arguments": {"words": args.sizes,
+                                 "alphabets": args.alphabets,
+                                 "prefixes": args.prefixes,
+                                 "lengths": args.lengths,
+                                 "calls": args.calls,
+                                 "repeat": args.repeat,
+                                 "seed": args.seed},
+                   "results": results}, args.output, indent=2,
+                  sort_keys=True)
+    if args.compare:
+        compare(results, json.load(args.compare)["results"])
@@ -2,8 +2,14 @@
 Setup module for wagoner.
 """
 
+import sys
 from setuptools import setup, find_packages
 
+scripts = ["wagoner/table.py", "wagoner/tree.py", "wagoner/word.py"]
+if sys.version_info >= (3, 7):
+    # The server needs Python 3.7 or later
+    scripts.append("wagoner/serve.py")
+
 with open("README.rst", "r") as readme:
     setup(
         name="wagoner",
@@ -22,13 +28,10 @@ with open("README.rst", "r") as readme:
             "Programming Language :: Python :: 2",
             "Programming Language :: Python :: 2.7",
             "Programming Language :: Python :: 3",
-            "Programming Language :: Python :: 3.4"
+            "Programming Language :: Python :: 3.4",
+            "Programming Language :: Python :: 3.7"
         ],
         keywords="random word generation",
         packages=find_packages(),
-        scripts=[
-            "wagoner/table.py",
-            "wagoner/tree.py",
-            "wagoner/word.py"
-        ]
+        scripts=scripts
     )
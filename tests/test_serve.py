@@ -0,0 +1,78 @@
+"""
+Tests of the serve module.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from wagoner.table import Table
+from wagoner.client import Client
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    from wagoner.serve import Server
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "the server needs Python 3.7")
+class ServerTest(unittest.TestCase):
+    """
+    Tests of a server running in a thread, on a Unix socket.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "wagoner.sock")
+        contents = {"A": Table.from_words(["ab", "ba", "aab", "bba"]),
+                    "X": Table.from_words(["xy", "yx", "xxy", "yyx"])}
+        self.server = Server(contents)
+        started = threading.Event()
+
+        async def serve():
+            self.loop = asyncio.get_running_loop()
+            self.task = asyncio.ensure_future(
+                self.server.serve(path=self.path))
+            started.set()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+        self.thread = threading.Thread(target=asyncio.run, args=(serve(),))
+        self.thread.start()
+        started.wait()
+        while not os.path.exists(self.path):
+            self.thread.join(0.01)
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_contents(self):
+        # The chunks of concurrent requests are interleaved, each request
+        # must keep generating from its own content
+        words = {}
+
+        def request(name):
+            with Client(path=self.path, timeout=60) as client:
+                words[name] = client.random_words(name, count=20000,
+                                                  length=4)
+
+        threads = [threading.Thread(target=request, args=(name,))
+                   for name in ("A", "X")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(words["A"]), 20000)
+        self.assertEqual(len(words["X"]), 20000)
+        self.assertTrue(all(set(word) <= set("ab") for word in words["A"]))
+        self.assertTrue(all(set(word) <= set("xy") for word in words["X"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
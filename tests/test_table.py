@@ -0,0 +1,66 @@
+"""
+Tests of the table module.
+"""
+
+import unittest
+
+from wagoner.table import Table
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+# Words whose contexts have successors of equal weights
+WORDS = ["abc", "abd", "acb", "bad", "bca", "cab", "cba", "dab", "dcb",
+         "abcd", "bcda", "cdab", "dabc", "aab", "bba", "ccd", "ddc"]
+
+
+class PruneTest(unittest.TestCase):
+    """
+    Tests of Table.prune.
+    """
+
+    settings = [{"min_count": 2}, {"max_kl": 0.05}, {"max_contexts": 20},
+                {"min_weight": 2}, {"min_count": 2, "min_weight": 3},
+                {"max_contexts": 12, "min_weight": 2}]
+
+    def assertPruned(self, table):
+        # Every context has a successor, and every successor but < is a
+        # context
+        for sub_word in table:
+            successors = table[sub_word]
+            self.assertTrue(successors, sub_word)
+            for successor in successors:
+                if successor != "<":
+                    self.assertIn(successor, table, (sub_word, successor))
+
+    def test_kept_successors(self):
+        for prefix in (0, 2, 3):
+            for settings in self.settings:
+                table = Table.from_words(WORDS, prefix=prefix)
+                table.prune(**settings)
+                self.assertPruned(table)
+
+    @unittest.skipIf(numpy is None, "dense tables need NumPy")
+    def test_dense(self):
+        from wagoner.dense import DenseTable
+        for prefix in (2, 3):
+            for settings in self.settings:
+                table = Table.from_words(WORDS, prefix=prefix)
+                dense = DenseTable.from_words(WORDS, prefix=prefix)
+                report = table.prune(**settings)
+                dense_report = dense.prune(**settings)
+                for name in ("contexts", "successors"):
+                    self.assertEqual(report[name], dense_report[name])
+                for name in ("mean_distance", "max_distance"):
+                    self.assertAlmostEqual(report[name], dense_report[name])
+                self.assertEqual({sub_word: dict(table[sub_word])
+                                  for sub_word in table},
+                                 {sub_word: dict(dense[sub_word])
+                                  for sub_word in dense})
+                self.assertPruned(dense)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+The client module requests random words from a server run by the serve
+module.
+
+Example:
+>>> with Client(path="/tmp/wagoner.sock") as client:
+...     words = client.random_words("english", count=5, length=8, prefix=3)
+"""
+
+import json
+import socket
+
+__all__ = ["Client", "ServerError"]
+
+
+class ServerError(Exception):
+    """
+    The server could not answer a request.
+    """
+    pass
+
+
+class Client(object):
+    """
+    A client of a wagoner server. The client keeps its connection open, such
+    that requests only wait for the generation of their words.
+    """
+
+    def __init__(self, path=None, host="127.0.0.1", port=None, timeout=None):
+        """
+        Connect to the server listening on the Unix socket at path, or on the
+        TCP port of host.
+
+        :param path: the path of the Unix socket of the server;
+        :param host: the host of the server, if path is None;
+        :param port: the TCP port of the server, if path is None;
+        :param timeout: if not None, the time to wait for an answer, in
+                        seconds.
+        """
+        if path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = path
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            address = (host, port)
+        self._socket.settimeout(timeout)
+        self._socket.connect(address)
+        self._file = self._socket.makefile("rwb")
+
+    def random_words(self, content, count=10, length=10, prefix=0,
+                     start=False, end=False, flatten=False, seed=None):
+        """
+        Return count random words of length generated by the server from the
+        given content.
+
+        :param content: the name of the table or tree on the server;
+        :param count: the number of words to generate;
+        :param length: the length of the generated words (ignored by trees);
+        :param prefix: if greater than 0, the maximum length of the prefix to
+                       consider to choose the next character;
+        :param start: if True, the generated words start as words of table;
+        :param end: if True, the generated words end as words of table;
+        :param flatten: whether or not consider the table as flattened;
+        :param seed: if not None, the seed of the generation;
+        :return: the list of generated words.
+        :raises ServerError: if the server could not generate the words.
+        """
+        request = {"content": content, "count": count, "length": length,
+                   "prefix": prefix, "start": start, "end": end,
+                   "flatten": flatten, "seed": seed}
+        self._file.write(json.dumps(request).encode("utf-8") + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ServerError("the server closed the connection")
+        answer = json.loads(line.decode("utf-8"))
+        if "error" in answer:
+            raise ServerError(answer["error"])
+        return answer["words"]
+
+    def random_word(self, content, length=10, prefix=0, start=False,
+                    end=False, flatten=False, seed=None):
+        """
+        Return a random word of length generated by the server from the given
+        content. See random_words for the arguments.
+        """
+        return self.random_words(content, count=1, length=length,
+                                 prefix=prefix, start=start, end=end,
+                                 flatten=flatten, seed=seed)[0]
+
+    def close(self):
+        """
+        Close the connection to the server.
+        """
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
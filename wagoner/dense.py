@@ -0,0 +1,448 @@
+"""
+The dense module stores tables as dense NumPy arrays instead of suffix tries.
+This representation fits tables built with a short prefix over a small
+alphabet (such as lowercase words with a prefix of 2 or 3): the table is then
+built with a few vectorized counts over the whole text, and the weighted
+choices of a word are computed with a few array operations.
+
+A dense table of prefix p stores, for each length k from 1 to p + 1 (the
+longest sub-words stored by a table of prefix p), an array of counts with a
+row per sub-word of length k over the alphabet of the table (the sub-word
+being read as a number in base the size of the alphabet) and a column per
+successing character. It thus takes A ** (p + 2) numbers (and a bit more)
+for an alphabet of A characters, whatever the size of the text.
+
+This module needs NumPy.
+"""
+
+from __future__ import division
+from collections import Counter, defaultdict, Mapping
+
+from wagoner.table import Table
+from wagoner import stats
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+__all__ = ["DenseTable"]
+
+# The largest weight computed with 64-bit integers
+_MAX_INT64 = 2 ** 63 - 1
+
+
+class _DenseNodes(object):
+    """
+    The read-only sequence of the children or the successors of the nodes of
+    a dense table, as mappings built from the arrays of the table.
+    """
+
+    def __init__(self, table, successors):
+        """
+        Create the sequence of the nodes of table.
+
+        :param table: the dense table;
+        :param successors: whether the mappings are the successors of the
+                           nodes, or their children.
+        """
+        self._table = table
+        self._successors = successors
+
+    def __getitem__(self, node):
+        return self._table._edges(node, self._successors)
+
+    def __len__(self):
+        return self._table._offsets[-1]
+
+
+class DenseTable(Table):
+    """
+    A table stored as dense arrays of counts, one per length of sub-words.
+    See the dense module.
+
+    The nodes of the suffix trie of a dense table are numbered level by
+    level: the root is node 0, and the sub-word of index i of length k is
+    node offsets[k] + i, that is, the row of the node in the array of the
+    rows of all nodes, of which the counts are views. A node is in the trie
+    if its sub-word, or a longer sub-word starting with it, has successors
+    (as the sub-words of a pruned table may have lost their successors but
+    not their longer sub-words); its children and successors are computed
+    from the arrays when needed. The alphabet of the table grows with the
+    words added to it.
+
+    Dense tables are built in memory only: they are pickled as is, but are
+    saved in binary format as a suffix trie, and loaded back as a
+    memory-mapped table.
+    """
+
+    max_cells = 1 << 25
+
+    def __init__(self, table=None, prefix=0, flatten=False):
+        """
+        Create a new dense table from table content.
+
+        :param table: the content of the new table, that is, a mapping of
+                      strings to mappings of successing characters and their
+                      weights; if None, the table is empty;
+        :param prefix: the maximum length of the prefixes stored in the
+                       table; > 0;
+        :param flatten: whether the table is flattened or not.
+        :raises ImportError: if NumPy is not available.
+        :raises ValueError: if prefix is 0.
+        """
+        if numpy is None:
+            raise ImportError("dense tables need NumPy")
+        if prefix <= 0:
+            raise ValueError("dense tables need a prefix greater than 0")
+        self.prefix = prefix
+        self.flatten = flatten
+        self.corpus = None
+        self._alphabet = []
+        self._index = {}
+        self._counts = [numpy.zeros((0, 0), dtype=numpy.int64)
+                        for _ in range(prefix + 1)]
+        self._refresh()
+        if table is not None:
+            self.merge(Table(table, prefix=prefix, flatten=flatten))
+
+    def _refresh(self):
+        """
+        Update the totals, the node offsets, the size and the caches of this
+        table after its counts changed.
+        """
+        size = len(self._alphabet)
+        self._offsets = [0, 1]
+        for length in range(1, len(self._counts) + 1):
+            self._offsets.append(self._offsets[-1] + size ** length)
+        # The rows of all nodes, the counts being views of these rows
+        self._rows = numpy.concatenate([numpy.zeros((1, size),
+                                                    dtype=numpy.int64)] +
+                                       self._counts)
+        self._counts = [self._rows[self._offsets[length]:
+                                   self._offsets[length + 1]]
+                        for length in range(1, len(self._counts) + 1)]
+        self._totals = [counts.sum(axis=1) for counts in self._counts]
+        # Whether each sub-word is a node of the trie, that is, whether it
+        # or one of its descendants has successors
+        self._nodes = [totals > 0 for totals in self._totals]
+        for length in range(len(self._nodes) - 1, 0, -1):
+            if size:
+                self._nodes[length - 1] |= (self._nodes[length]
+                                            .reshape(-1, size).any(axis=1))
+        self._size = sum(int(numpy.count_nonzero(totals))
+                         for totals in self._totals)
+        self._children = _DenseNodes(self, False)
+        self._successors = _DenseNodes(self, True)
+        self._reset_caches()
+
+    def _embed(self, counts, length, positions, size):
+        """
+        Return the given counts of sub-words of length, over an alphabet of
+        len(positions) characters, moved to a larger alphabet.
+
+        :param counts: the (sub-word, successor) array of counts;
+        :param length: the length of the sub-words of counts;
+        :param positions: the index in the larger alphabet of each character
+                          of the alphabet of counts;
+        :param size: the size of the larger alphabet;
+        :return: the array of counts over the larger alphabet.
+        """
+        shape = (len(positions),) * (length + 1)
+        embedded = numpy.zeros((size,) * (length + 1), dtype=numpy.int64)
+        if len(positions):
+            embedded[numpy.ix_(*[positions] * (length + 1))] = \
+                counts.reshape(shape)
+        return embedded.reshape(size ** length, size)
+
+    def _extend(self, characters):
+        """
+        Add the given characters to the alphabet of this table.
+
+        :param characters: an iterable of characters;
+        :raises ValueError: if the extended table would have more than
+                            max_cells counts.
+        """
+        alphabet = sorted(set(self._alphabet).union(characters))
+        if len(alphabet) == len(self._alphabet):
+            return
+        size = len(alphabet)
+        cells = sum(size ** (length + 1)
+                    for length in range(1, len(self._counts) + 1))
+        if cells > self.max_cells:
+            raise ValueError("a dense table of %d characters and prefix %d "
+                             "needs too many cells (%d)" %
+                             (size, self.prefix, cells))
+        index = {character: position
+                 for position, character in enumerate(alphabet)}
+        positions = numpy.array([index[character]
+                                 for character in self._alphabet],
+                                dtype=numpy.int64)
+        self._counts = [self._embed(counts, length, positions, size)
+                        for length, counts in enumerate(self._counts, 1)]
+        self._alphabet = alphabet
+        self._index = index
+        self._refresh()
+
+    def _count(self, words):
+        """
+        Return the counts of the sub-words of the given words, over the
+        alphabet of this table.
+
+        :param words: a mapping of words to their number of occurrences; all
+                      their characters are in the alphabet of this table;
+        :return: the list of the (sub-word, successor) arrays of counts, one
+                 per length of sub-words.
+
+        The words are joined into one array of character indices, and the
+        occurrences of the sub-words of each length are counted at once.
+        """
+        size = len(self._alphabet)
+        text = "".join(">" + word + "<" for word in words)
+        codes = numpy.frombuffer(text.encode("utf-32-le"), dtype="<u4")
+        codes = numpy.searchsorted(numpy.array([ord(character) for character
+                                                in self._alphabet]), codes)
+        lengths = numpy.array([len(word) + 2 for word in words],
+                              dtype=numpy.int64)
+        weights = numpy.repeat(numpy.array([words[word] for word in words],
+                                           dtype=numpy.float64), lengths)
+        # The position of each character in its word
+        positions = (numpy.arange(len(codes)) -
+                     numpy.repeat(numpy.cumsum(lengths) - lengths, lengths))
+        contexts = numpy.zeros(len(codes), dtype=numpy.int64)
+        counts = []
+        for length in range(1, len(self._counts) + 1):
+            # contexts[i] is the index of the sub-word ending before i
+            contexts[length:] += codes[:-length] * size ** (length - 1)
+            valid = positions >= length
+            cells = contexts[valid] * size + codes[valid]
+            counts.append(numpy.bincount(cells, weights=weights[valid],
+                                         minlength=size ** (length + 1))
+                          .astype(numpy.int64)
+                          .reshape(size ** length, size))
+        return counts
+
+    def update(self, words):
+        """
+        Add the occurrences of the sub-words of the given words to this table,
+        as if the table were built from its words and these ones. The prefix
+        and flatten of this table are kept.
+
+        :param words: an iterable of strings made of alphabetic characters,
+                      or a mapping of such strings to their number of
+                      occurrences;
+        :return: this table.
+        """
+        words = words if isinstance(words, Mapping) else Counter(words)
+        if self.corpus is not None:
+            self.corpus.update(words)
+        if words:
+            self._extend(set("".join(words)).union("<>"))
+            self._counts = [counts + added for counts, added
+                            in zip(self._counts, self._count(words))]
+        self._refresh()
+        return self
+
+    def remove(self, words):
+        """
+        Remove the occurrences of the sub-words of the given words from this
+        table, as if the table were built from its words without these ones.
+
+        :param words: an iterable of strings made of alphabetic characters,
+                      or a mapping of such strings to their number of
+                      occurrences; they must have been added to this table
+                      before;
+        :return: this table.
+        :raises ValueError: if the words were not all added to this table; in
+                            this case, the table is left unchanged.
+        """
+        words = words if isinstance(words, Mapping) else Counter(words)
+        if not words:
+            return self
+        if not set("".join(words)) <= set(self._alphabet):
+            raise ValueError("cannot remove words that are not in the table")
+        removed = self._count(words)
+        if any((counts < other).any()
+               for counts, other in zip(self._counts, removed)):
+            raise ValueError("cannot remove words that are not in the table")
+        self._counts = [counts - other
+                        for counts, other in zip(self._counts, removed)]
+        self._refresh()
+        return self
+
+    def merge(self, other):
+        """
+        Add the weights of other to the weights of this table.
+
+        :param other: the table to merge into this one, dense or not; it must
+                      be built with the same prefix and flatten as this table;
+        :return: this table.
+        :raises ValueError: if other is not built with the same prefix and
+                            flatten as this table.
+        """
+        if other.prefix != self.prefix or other.flatten != self.flatten:
+            raise ValueError("cannot merge tables built with different "
+                             "prefix or flatten")
+        self._merge_corpus(other)
+        if isinstance(other, DenseTable):
+            self._extend(other._alphabet)
+            positions = numpy.array([self._index[character]
+                                     for character in other._alphabet],
+                                    dtype=numpy.int64)
+            size = len(self._alphabet)
+            self._counts = [counts + self._embed(added, length, positions,
+                                                 size)
+                            for length, (counts, added)
+                            in enumerate(zip(self._counts, other._counts), 1)]
+        else:
+            contexts = []
+            pending = [(0, "")]
+            while pending:
+                node, sub_word = pending.pop()
+                if other._successors[node]:
+                    contexts.append((sub_word, other._successors[node]))
+                for character, child in other._children[node].items():
+                    pending.append((child, sub_word + character))
+            self._extend(set("".join(sub_word + "".join(successors)
+                                     for sub_word, successors in contexts)))
+            size = len(self._alphabet)
+            for sub_word, successors in contexts:
+                row = 0
+                for character in sub_word:
+                    row = row * size + self._index[character]
+                counts = self._counts[len(sub_word) - 1][row]
+                for successor, weight in successors.items():
+                    counts[self._index[successor]] += weight
+        self._refresh()
+        return self
+
+    def prune(self, *args, **kwargs):
+        """
+        Prune this table as a suffix trie, and store the pruned table back in
+        the arrays of this table. See Table.prune.
+        """
+        table = Table(prefix=self.prefix, flatten=self.flatten).merge(self)
+        report = table.prune(*args, **kwargs)
+        self._counts = [numpy.zeros_like(counts) for counts in self._counts]
+        self._refresh()
+        self.merge(table)
+        return report
+
+    def __getstate__(self):
+        state = Table.__getstate__(self)
+        for name in ("_children", "_successors", "_rows", "_totals",
+                     "_nodes", "_offsets"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._refresh()
+
+    def _level(self, node):
+        """
+        Return the length and the index of the sub-word of node.
+        """
+        for length in range(len(self._counts), 0, -1):
+            if node >= self._offsets[length]:
+                return length, node - self._offsets[length]
+        return 0, 0
+
+    def _edges(self, node, successors):
+        """
+        Return the successors or the children of node, as a dictionary.
+
+        :param node: the identifier of the node;
+        :param successors: whether to return the successors of node (and
+                           their weights), or its children (and their
+                           identifiers).
+        """
+        length, index = self._level(node)
+        if successors:
+            if length == 0:
+                return {}
+            row = self._rows[node]
+            return {self._alphabet[position]: int(row[position])
+                    for position in numpy.flatnonzero(row).tolist()}
+        if length == len(self._counts):
+            return {}
+        size = len(self._alphabet)
+        first = index * size
+        nodes = self._nodes[length][first:first + size]
+        base = self._offsets[length + 1] + first
+        return {self._alphabet[position]: base + position
+                for position in numpy.flatnonzero(nodes).tolist()}
+
+    def _find(self, sub_word):
+        if len(sub_word) > len(self._counts):
+            return None
+        size = len(self._alphabet)
+        index = 0
+        for length, character in enumerate(sub_word, 1):
+            position = self._index.get(character)
+            if position is None:
+                return None
+            index = index * size + position
+            if not self._nodes[length - 1][index]:
+                return None
+        return self._offsets[len(sub_word)] + index
+
+    def _advance(self, contexts, character, prefix=0):
+        position = self._index.get(character)
+        if position is None:
+            return ()
+        size = len(self._alphabet)
+        levels = len(self._counts)
+        advanced = []
+        if self._nodes[0][position]:
+            advanced.append((self._offsets[1] + position, 1))
+        for node, length in contexts:
+            if (prefix > 0 and length >= prefix) or length >= levels:
+                break
+            index = (node - self._offsets[length]) * size + position
+            if self._nodes[length][index]:
+                advanced.append((self._offsets[length + 1] + index,
+                                 length + 1))
+        return tuple(advanced)
+
+    def _ends(self, contexts):
+        return (bool(contexts) and contexts[0][1] == 1 and
+                bool(self._rows[contexts[0][0], self._index["<"]]))
+
+    def _weighted_choices(self, contexts, exclude=None, flatten=False):
+        """
+        Return the weighted choices for a word of the given contexts. See
+        Table.weighted_choices.
+
+        The rows of the contexts are stacked into one array, the excluded
+        characters are masked, and the choices are the sum of the rows
+        scaled by the total weight of the shorter contexts.
+        """
+        flatten = flatten or self.flatten
+        weighted_choices = defaultdict(int)
+        stats.count("table.weighted_choices")
+        stats.count("table.suffixes_scanned", len(contexts))
+        if not contexts:
+            return weighted_choices
+        rows = self._rows[[node for node, _ in contexts]]
+        if flatten:
+            rows = (rows > 0).astype(numpy.int64)
+        if exclude:
+            rows[:, [self._index[character] for character in exclude
+                     if character in self._index]] = 0
+        scales = []
+        total_sum = 1
+        for current_sum in rows.sum(axis=1).tolist():
+            scales.append(total_sum)
+            total_sum += current_sum * total_sum
+        if total_sum > _MAX_INT64:
+            # The weights do not fit in 64 bits
+            choices = numpy.dot(numpy.array(scales, dtype=object),
+                                rows.astype(object))
+        else:
+            choices = numpy.dot(numpy.array(scales, dtype=numpy.int64), rows)
+        positions = numpy.flatnonzero(choices)
+        for position, weight in zip(positions.tolist(),
+                                    choices[positions].tolist()):
+            weighted_choices[self._alphabet[position]] = weight
+        return weighted_choices
@@ -0,0 +1,369 @@
+#! /usr/bin/env python3
+
+"""
+The serve module runs a local server generating random words from tables and
+trees loaded once, when the server starts.
+
+The server listens on a Unix socket or on a local TCP port. Each request is a
+JSON object on one line, giving the name of the content to generate words from
+and the settings of the generation (count, length, prefix, start, end,
+flatten and seed, with the defaults of the word module); each answer is a
+JSON object on one line, with the generated words ("words") or an error
+message ("error"), and the identifier ("id") of the request if it has one.
+Requests sent on the same connection are answered in order.
+
+Concurrent requests for the same content and settings (but count) are
+batched: their words are generated together, then split between the
+requests. Seeded requests are not batched, such that they generate the same
+words as the word module with the same seed; they do not change the random
+state of the other requests. The words are generated in a separate thread,
+by chunks, such that the server keeps accepting requests and concurrent
+requests take turns.
+
+The client module provides a client for this server. This module needs
+Python 3.7 or later.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import pickle
+import random
+from wagoner.utils import *
+from wagoner.table import Table
+from wagoner.tree import LazyTree
+from wagoner.word import generate
+from wagoner import storage
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+__all__ = ["Server"]
+
+# The settings of the requests, with their default values
+SETTINGS = (("count", 10), ("length", 10), ("prefix", 0), ("start", False),
+            ("end", False), ("flatten", False), ("seed", None))
+
+
+class Server(object):
+    """
+    A server generating random words from named tables and trees.
+    """
+
+    def __init__(self, contents, delay=0.001, max_count=1000000,
+                 max_nodes=1000000):
+        """
+        Create a new server for the given contents.
+
+        :param contents: a mapping of names to tables and trees;
+        :param delay: the time, in seconds, to wait for concurrent requests
+                      before generating words;
+        :param max_count: the maximum number of words of a request;
+        :param max_nodes: the maximum number of tree nodes kept in memory when
+                          generating ending words from a table.
+        """
+        self.contents = contents
+        self.delay = delay
+        self.max_count = max_count
+        self.max_nodes = max_nodes
+        self._lazy_trees = {}
+        self._queue = None
+        self._executor = None
+        self._tasks = set()
+
+    def _content(self, name, length, prefix, end, flatten):
+        """
+        Return the content to generate words from, for the given settings.
+
+        :raises ValueError: if there is no content called name.
+        """
+        if name not in self.contents:
+            raise ValueError("unknown content: %s" % name)
+        content = self.contents[name]
+        if end and isinstance(content, Table):
+            key = (name, length, prefix, flatten)
+            if key not in self._lazy_trees:
+                self._lazy_trees[key] = LazyTree(content, length,
+                                                 prefix=prefix,
+                                                 flatten=flatten,
+                                                 max_nodes=self.max_nodes)
+            content = self._lazy_trees[key]
+        return content
+
+    def _parse(self, request):
+        """
+        Return the name and the settings of the given request.
+
+        :raises ValueError: if the request is not valid.
+        """
+        if "content" not in request:
+            raise ValueError("a request must have a content")
+        settings = tuple(request.get(name, default)
+                         for name, default in SETTINGS)
+        count, length, prefix, start, end, flatten, seed = settings
+        for name, value in (("count", count), ("length", length),
+                            ("prefix", prefix)):
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("%s must be a natural number" % name)
+        if length == 0:
+            raise ValueError("length must be a positive number")
+        if count > self.max_count:
+            raise ValueError("count must be at most %d" % self.max_count)
+        if seed is not None and (not isinstance(seed, int) or seed < 0):
+            raise ValueError("seed must be a natural number")
+        return request["content"], (count, length, prefix, bool(start),
+                                    bool(end), bool(flatten), seed)
+
+    def _chunks(self, name, settings):
+        """
+        Return a generator of the chunks of words generated for the given
+        content and settings, as strings of words, one per line.
+        """
+        count, length, prefix, start, end, flatten, seed = settings
+        content = self._content(name, length, prefix, end, flatten)
+        return generate(content, count, length, prefix=prefix, start=start,
+                        end=end, flatten=flatten, seed=seed)
+
+    @staticmethod
+    def _next_chunk(chunks, seeded):
+        """
+        Return the next chunk of chunks, or None if there is none left.
+
+        Seeded chunks reseed the random generators; their states are restored
+        afterwards, such that the unseeded generations stay random.
+        """
+        if seeded:
+            state = random.getstate()
+            numpy_state = numpy.random.get_state() if numpy else None
+        try:
+            return next(chunks, None)
+        finally:
+            if seeded:
+                random.setstate(state)
+                if numpy is not None:
+                    numpy.random.set_state(numpy_state)
+
+    async def _generate(self, name, settings):
+        """
+        Return the words generated for the given content and settings.
+
+        The words are generated by the thread of the server, one chunk at a
+        time, such that concurrent generations take turns and a large
+        request does not delay the small ones until it is answered.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = self._chunks(name, settings)
+        words = []
+        while True:
+            chunk = await loop.run_in_executor(self._executor,
+                                               self._next_chunk, chunks,
+                                               settings[-1] is not None)
+            if chunk is None:
+                return words
+            words.extend(chunk.split())
+
+    async def _answer_group(self, name, settings, group):
+        """
+        Answer a group of batched requests, generating their words together
+        and splitting them between the requests.
+
+        :param name: the name of the content of the requests;
+        :param settings: the settings of the requests, but count;
+        :param group: the list of (count, future) pairs of the requests.
+        """
+        total = sum(count for count, _ in group)
+        try:
+            words = await self._generate(name, (total,) + settings)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            # The error is the answer of every request of the group
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        first = 0
+        for count, future in group:
+            if not future.done():
+                future.set_result(words[first:first + count])
+            first += count
+
+    async def _batch(self):
+        """
+        Answer the queued requests, batching the concurrent ones.
+        """
+        while True:
+            requests = [await self._queue.get()]
+            await asyncio.sleep(self.delay)
+            while not self._queue.empty():
+                requests.append(self._queue.get_nowait())
+            groups = {}
+            for name, settings, future in requests:
+                # Requests differing by their count only are batched, but
+                # seeded requests are never batched
+                key = ((name, settings[1:]) if settings[-1] is None
+                       else (name, settings[1:], id(future)))
+                groups.setdefault(key, []).append((settings[0], future))
+            for key, group in groups.items():
+                task = asyncio.ensure_future(
+                    self._answer_group(key[0], key[1], group))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _answer(self, line):
+        """
+        Return the answer to the request of the given line.
+        """
+        answer = {}
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request must be an object")
+            if "id" in request:
+                answer["id"] = request["id"]
+            name, settings = self._parse(request)
+            future = asyncio.get_running_loop().create_future()
+            self._queue.put_nowait((name, settings, future))
+            answer["words"] = await future
+        except (ValueError, GenerationError) as error:
+            answer["error"] = str(error)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            answer["error"] = "%s: %s" % (type(error).__name__, error)
+        return answer
+
+    async def _handle(self, reader, writer):
+        """
+        Answer the requests of a connection until it is closed.
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                answer = await self._answer(line.decode("utf-8"))
+                writer.write(json.dumps(answer).encode("utf-8") + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host="127.0.0.1", port=None):
+        """
+        Serve the requests on the Unix socket at path, or on the TCP port of
+        host, until cancelled.
+
+        :param path: the path of the Unix socket;
+        :param host: the host to listen on, if path is None;
+        :param port: the TCP port to listen on, if path is None.
+        """
+        self._queue = asyncio.Queue()
+        # A single thread generates the words, as the tables and the random
+        # generators are not thread-safe
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        batch = asyncio.ensure_future(self._batch())
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle, path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        try:
+            await asyncio.Future()
+        finally:
+            batch.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+            server.close()
+            await server.wait_closed()
+            self._executor.shutdown(wait=False)
+            if path is not None:
+                os.remove(path)
+
+
+def load_content(path):
+    """
+    Load the table or tree at path, saved in binary format or pickled.
+
+    :param path: the path of the table or tree;
+    :return: the loaded table or tree.
+    """
+    if storage.is_binary(path):
+        return storage.load(path)
+    with open(path, "rb") as content_file:
+        return pickle.load(content_file)
+
+
+def named_path(value):
+    """
+    Return the (name, path) pair of value, of the form name=path.
+
+    :param value: the string to parse;
+    :return: the name and the path of value.
+    :raises argparse.ArgumentTypeError: if value is not of the form name=path.
+    """
+    name, separator, path = value.partition("=")
+    if not separator or not name or not path:
+        raise argparse.ArgumentTypeError("%s is not of the form name=path" %
+                                         value)
+    return name, path
+
+
+def process_arguments():
+    """
+    Process the command line arguments. The arguments are:
+     * the contents to serve, as name=path pairs (at least one);
+     * -u (or --socket) for the path of the Unix socket to listen on;
+     * --host for the host to listen on (default: 127.0.0.1);
+     * --port for the TCP port to listen on;
+     * --delay for the time to wait for concurrent requests, in milliseconds
+       (default: 1);
+     * --max-count for the maximum number of words of a request
+       (default: 1000000);
+     * --max-nodes for the maximum number of tree nodes kept in memory when
+       generating ending words from a table (default: 1000000).
+    """
+    parser = argparse.ArgumentParser(description="Serve random words "
+                                                 "generated from the given "
+                                                 "contents",
+                                     epilog="Contents are pickled or binary "
+                                            "tables and trees, loaded once. "
+                                            "Requests and answers are JSON "
+                                            "objects, one per line.")
+    parser.add_argument("contents", type=named_path, nargs="+",
+                        help="the contents to serve, as name=path")
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--socket", "-u", default=None, dest="socket",
+                         help="the path of the Unix socket to listen on")
+    address.add_argument("--port", type=nonzero_natural, default=None,
+                         dest="port", help="the TCP port to listen on")
+    parser.add_argument("--host", default="127.0.0.1", dest="host",
+                        help="the host to listen on (default: 127.0.0.1)")
+    parser.add_argument("--delay", type=natural, default=1, dest="delay",
+                        help="the time to wait for concurrent requests, in "
+                             "milliseconds (default: 1)")
+    parser.add_argument("--max-count", type=nonzero_natural, default=1000000,
+                        dest="max_count", help="the maximum number of words "
+                                               "of a request "
+                                               "(default: 1000000)")
+    parser.add_argument("--max-nodes", type=nonzero_natural, default=1000000,
+                        dest="max_nodes", help="the maximum number of tree "
+                                               "nodes kept in memory when "
+                                               "generating ending words from "
+                                               "a table (default: 1000000)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = process_arguments()
+    contents = {name: load_content(path) for name, path in args.contents}
+    server = Server(contents, delay=args.delay / 1000,
+                    max_count=args.max_count, max_nodes=args.max_nodes)
+    try:
+        asyncio.run(server.serve(path=args.socket, host=args.host,
+                                 port=args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,163 @@
+"""
+The stats module collects statistics about the work done by wagoner: the
+number of times hot paths are taken (such as computing weighted choices or
+backtracking during generation) and the time spent in each phase of a run
+(such as loading a table or generating words).
+
+Statistics are reported to hooks. A hook is an object with the methods of the
+Hook class; hooks are registered with register and removed with unregister.
+When no hook is registered, reporting statistics costs a function call.
+Statistics is a hook accumulating the reported statistics per phase.
+"""
+
+from __future__ import division
+from collections import OrderedDict
+import timeit
+
+__all__ = ["Hook", "Statistics", "register", "unregister", "count", "phase"]
+
+_hooks = []
+
+
+class Hook(object):
+    """
+    A hook receives the statistics reported by wagoner. This class ignores
+    them; subclasses override the methods for the statistics they need.
+    """
+
+    def count(self, name, value):
+        """
+        Receive the fact that the event name occurred value times.
+
+        :param name: the name of the event;
+        :param value: the number of occurrences.
+        """
+        pass
+
+    def enter(self, name):
+        """
+        Receive the fact that the phase name starts.
+
+        :param name: the name of the phase.
+        """
+        pass
+
+    def exit(self, name, seconds):
+        """
+        Receive the fact that the phase name ends.
+
+        :param name: the name of the phase;
+        :param seconds: the time spent in the phase, in seconds.
+        """
+        pass
+
+
+class Statistics(Hook):
+    """
+    A hook accumulating, for each phase, the time spent in the phase and the
+    number of occurrences of each event reported during the phase. Events
+    reported outside of any phase are accumulated in the phase named None.
+    """
+
+    def __init__(self):
+        """
+        Create a new empty statistics.
+        """
+        self.phases = OrderedDict()
+        self._current = [None]
+
+    def _phase(self, name):
+        """
+        Return the statistics of the given phase, creating them if needed.
+        """
+        if name not in self.phases:
+            self.phases[name] = {"seconds": 0, "counts": OrderedDict()}
+        return self.phases[name]
+
+    def count(self, name, value):
+        counts = self._phase(self._current[-1])["counts"]
+        counts[name] = counts.get(name, 0) + value
+
+    def enter(self, name):
+        self._phase(name)
+        self._current.append(name)
+
+    def exit(self, name, seconds):
+        self._current.pop()
+        self._phase(name)["seconds"] += seconds
+
+    def report(self):
+        """
+        Return a human-readable report of these statistics.
+
+        :return: the report, one line per phase and per event.
+        """
+        lines = []
+        for name, statistics in self.phases.items():
+            if name is None:
+                lines.append("(no phase)")
+            else:
+                lines.append("%s: %.3fs" % (name, statistics["seconds"]))
+            for event, value in statistics["counts"].items():
+                lines.append("    %s: %d" % (event, value))
+        return "\n".join(lines)
+
+
+def register(hook):
+    """
+    Register the given hook, such that it receives the reported statistics.
+
+    :param hook: the hook to register.
+    """
+    _hooks.append(hook)
+
+
+def unregister(hook):
+    """
+    Remove the given hook from the registered hooks.
+
+    :param hook: the hook to remove.
+    """
+    _hooks.remove(hook)
+
+
+def count(name, value=1):
+    """
+    Report that the event name occurred value times.
+
+    :param name: the name of the event;
+    :param value: the number of occurrences (default: 1).
+    """
+    for hook in _hooks:
+        hook.count(name, value)
+
+
+class phase(object):
+    """
+    A context manager reporting the start and the end of a phase.
+
+    Example:
+    >>> with phase("generate"):
+    ...     words = table.random_words(10, 10)
+    """
+
+    def __init__(self, name):
+        """
+        Create a new phase.
+
+        :param name: the name of the phase.
+        """
+        self.name = name
+        self._start = None
+
+    def __enter__(self):
+        for hook in _hooks:
+            hook.enter(self.name)
+        self._start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = timeit.default_timer() - self._start
+        for hook in _hooks:
+            hook.exit(self.name, seconds)
+        return False
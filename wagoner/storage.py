@@ -0,0 +1,948 @@
+"""
+The storage module saves tables and trees into a compact binary format, and
+loads them back lazily by memory-mapping the saved file.
+
+A binary file starts with a header giving the magic string, the version of the
+format, the byte order of the arrays, the kind of content (table or tree) and
+the number of sections. It is followed by a directory of sections, giving for
+each section its name, the type and size of its items, its offset in the file
+and its number of items. Each section is a flat array of numbers:
+
+* a table is saved as its suffix trie, where characters are replaced by their
+  index in the alphabet of the table; the children and the successors of the
+  nodes are stored in flat arrays, the children and successors of node n
+  being between offsets[n] and offsets[n + 1];
+* a tree is saved as its compressed sparse rows: the sizes of its nodes, the
+  identifiers of their suffixes (each distinct suffix being integer-encoded
+  with the alphabet of the tree once), and the flat arrays of the edges of
+  the nodes, with their targets, characters, weights and alias tables.
+
+Tables and trees with a Bloom filter of their corpus also save the bits of
+the filter in a section, and its size, number of hashes and number of words
+in another.
+
+Loading a binary file only reads its header; the content is read from the
+mapped file when needed.
+
+Trees too large to be built in memory can be built with build_tree, which
+keeps the levels of the tree in temporary files and writes the binary file
+directly.
+"""
+
+from __future__ import division
+import array
+import bisect
+import heapq
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import sys
+import tempfile
+from collections import Mapping
+
+from wagoner.table import Table, MixedTable
+from wagoner.dense import DenseTable
+from wagoner.tree import Tree, EXPANDED_EDGE_BYTES
+from wagoner.utils import BloomFilter, alias_table
+from wagoner import stats
+
+__all__ = ["dump", "load", "is_binary", "build_tree", "MappedTable",
+           "MappedTree"]
+
+MAGIC = b"WAGONER\0"
+VERSION = 2
+TABLE, TREE = 1, 2
+# The versions of the format each kind of content can be read from
+_VERSIONS = {TABLE: (1, 2), TREE: (2,)}
+
+_HEADER = struct.Struct("<8sHHII")
+_SECTION = struct.Struct("<32sBB6xQQ")
+_BYTEORDERS = ("little", "big")
+
+
+def is_binary(path):
+    """
+    Return whether the file at path is saved in the binary format.
+
+    :param path: the path of the file;
+    :return: True if the file starts with the magic string of the format.
+    """
+    with open(path, "rb") as content_file:
+        return content_file.read(len(MAGIC)) == MAGIC
+
+
+def dump(content, output):
+    """
+    Save the given table or tree into output, in the binary format.
+
+    :param content: the table or tree to save;
+    :param output: the binary file object to write to.
+    :raises TypeError: if content is neither a table nor a tree, or is a
+                       mixed table.
+    """
+    if isinstance(content, MixedTable):
+        # Mixed tables only refer to their tables, that are saved separately
+        raise TypeError("cannot save mixed tables in binary format")
+    if isinstance(content, DenseTable):
+        # Dense tables are saved as suffix tries
+        content = Table(prefix=content.prefix,
+                        flatten=content.flatten).merge(content)
+    if isinstance(content, Table):
+        kind, sections = TABLE, _table_sections(content)
+    elif isinstance(content, Tree):
+        kind, sections = TREE, _tree_sections(content)
+    else:
+        raise TypeError("cannot save %s in binary format" %
+                        type(content).__name__)
+    directory = _write_directory(output, kind,
+                                 [(name, values.typecode, len(values))
+                                  for name, values in sections])
+    position = _HEADER.size + _SECTION.size * len(sections)
+    for (name, values), (_, _, offset, _) in zip(sections, directory):
+        output.write(b"\0" * (offset - position))
+        output.write(_bytes(values))
+        position = offset + values.itemsize * len(values)
+
+
+def _bytes(values):
+    """
+    Return the bytes of the given array.
+    """
+    return values.tostring() if sys.version_info[0] < 3 else values.tobytes()
+
+
+def _write_directory(output, kind, sections):
+    """
+    Write the header and the directory of a binary file into output.
+
+    :param output: the binary file object to write to;
+    :param kind: the kind of content of the file;
+    :param sections: the list of the (name, typecode, length) triples of the
+                     sections of the file;
+    :return: the list of the (name, typecode, offset, length) tuples of the
+             sections, where offset is the position of the section in the
+             file.
+    """
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    directory = []
+    for name, typecode, length in sections:
+        offset += -offset % 8
+        directory.append((name, typecode, offset, length))
+        offset += array.array(typecode).itemsize * length
+    output.write(_HEADER.pack(MAGIC, VERSION,
+                              _BYTEORDERS.index(sys.byteorder), kind,
+                              len(sections)))
+    for name, typecode, offset, length in directory:
+        output.write(_SECTION.pack(name.encode("ascii"), ord(typecode),
+                                   array.array(typecode).itemsize, offset,
+                                   length))
+    return directory
+
+
+def load(path):
+    """
+    Load the table or tree saved in the binary format at path.
+
+    :param path: the path of the file;
+    :return: the loaded table (a MappedTable) or tree (a MappedTree).
+    :raises ValueError: if the file is not a valid binary file.
+    """
+    storage = _Storage(path)
+    if storage.kind == TABLE:
+        return MappedTable(storage)
+    else:
+        return MappedTree(storage)
+
+
+def _alphabet(characters):
+    """
+    Return the sorted alphabet of characters and the index of each character.
+
+    :param characters: an iterable of characters;
+    :return: a (alphabet, index) pair, where alphabet is the sorted list of
+             the characters and index the mapping of each character to its
+             position in alphabet.
+    """
+    alphabet = sorted(set(characters))
+    return alphabet, {character: index
+                      for index, character in enumerate(alphabet)}
+
+
+def _compact(values):
+    """
+    Return the given integers as an array of the smallest unsigned type able
+    to store them.
+
+    :param values: a list of non-negative integers;
+    :return: an array of values.
+    """
+    return array.array(_typecode(max(values) if values else 0), values)
+
+
+def _typecode(maximum):
+    """
+    Return the typecode of the smallest unsigned type able to store the
+    integers up to maximum.
+    """
+    for typecode in "BHIL":
+        if maximum < 256 ** array.array(typecode).itemsize:
+            return typecode
+    return "Q"
+
+
+def _corpus_sections(content):
+    """
+    Return the sections of the corpus filter of the given content.
+
+    :param content: the table or tree;
+    :return: the list of (name, array) pairs of the sections of the corpus
+             filter of content, empty if content has no filter.
+    """
+    corpus = getattr(content, "corpus", None)
+    if corpus is None:
+        return []
+    return [("corpus_meta", _compact([corpus.size, corpus.hashes,
+                                      corpus.count])),
+            ("corpus_bits", array.array("B", bytearray(corpus.bits)))]
+
+
+def _table_sections(table):
+    """
+    Return the sections of the given table.
+
+    :param table: the table;
+    :return: the list of (name, array) pairs of the sections of table.
+    """
+    alphabet, index = _alphabet(character
+                                for nodes in (table._children,
+                                              table._successors)
+                                for node in nodes for character in node)
+    child_offsets = [0]
+    child_characters = []
+    children = []
+    successor_offsets = [0]
+    successor_characters = []
+    weights = []
+    for node in range(len(table._children)):
+        for character, child in sorted(table._children[node].items()):
+            child_characters.append(index[character])
+            children.append(child)
+        child_offsets.append(len(children))
+        for character, weight in sorted(table._successors[node].items()):
+            successor_characters.append(index[character])
+            weights.append(weight)
+        successor_offsets.append(len(weights))
+    meta = [table.prefix, int(table.flatten), len(table)]
+    return _corpus_sections(table) + [
+            ("meta", _compact(meta)),
+            ("alphabet", _compact([ord(c) for c in alphabet])),
+            ("child_offsets", _compact(child_offsets)),
+            ("child_characters", _compact(child_characters)),
+            ("children", _compact(children)),
+            ("successor_offsets", _compact(successor_offsets)),
+            ("successor_characters", _compact(successor_characters)),
+            ("weights", _compact(weights))]
+
+
+def _tree_sections(tree):
+    """
+    Return the sections of the given tree.
+
+    :param tree: the tree;
+    :return: the list of (name, array) pairs of the sections of tree.
+    """
+    alphabet, index = _alphabet(character for suffix in set(tree._suffixes)
+                                for character in suffix)
+    strings = {}  # The identifier of each distinct suffix
+    string_offsets = [0]
+    string_characters = []
+    suffixes = []
+    for suffix in tree._suffixes:
+        if suffix not in strings:
+            strings[suffix] = len(strings)
+            string_characters.extend(index[character] for character in suffix)
+            string_offsets.append(len(string_characters))
+        suffixes.append(strings[suffix])
+    return _corpus_sections(tree) + [
+            ("meta", _compact([len(tree)])),
+            ("alphabet", _compact([ord(c) for c in alphabet])),
+            ("string_offsets", _compact(string_offsets)),
+            ("string_characters", _compact(string_characters)),
+            ("suffixes", _compact(suffixes)),
+            ("sizes", _compact(list(tree._sizes))),
+            ("offsets", _compact(list(tree._offsets))),
+            ("targets", _compact(list(tree._targets))),
+            ("characters", _compact(list(tree._characters))),
+            ("weights", array.array("d", tree._weights)),
+            ("probabilities", array.array("d", tree._probabilities)),
+            ("aliases", _compact(list(tree._aliases)))]
+
+
+class _Storage(object):
+    """
+    A memory-mapped binary file, whose sections are read on demand.
+    """
+
+    def __init__(self, path):
+        """
+        Open the binary file at path and read its header.
+
+        :param path: the path of the file;
+        :raises ValueError: if the file is not a valid binary file.
+        """
+        self.path = path
+        with open(path, "rb") as content_file:
+            self._map = mmap.mmap(content_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        if len(self._map) < _HEADER.size:
+            raise ValueError("%s is not a wagoner binary file" % path)
+        magic, version, byteorder, kind, count = _HEADER.unpack_from(
+            self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a wagoner binary file" % path)
+        if version not in _VERSIONS.get(kind, ()):
+            raise ValueError("%s has unsupported format version %d" %
+                             (path, version))
+        self.kind = kind
+        self._swap = _BYTEORDERS[byteorder] != sys.byteorder
+        self._sections = {}
+        for number in range(count):
+            name, typecode, itemsize, offset, length = _SECTION.unpack_from(
+                self._map, _HEADER.size + number * _SECTION.size)
+            typecode = chr(typecode)
+            if array.array(typecode).itemsize != itemsize:
+                raise ValueError("%s uses unsupported item sizes" % path)
+            self._sections[name.rstrip(b"\0").decode("ascii")] = (
+                typecode, itemsize, offset, length)
+        self._arrays = {}
+
+    def __contains__(self, name):
+        return name in self._sections
+
+    def __getitem__(self, name):
+        """
+        Return the array of the section with the given name.
+
+        :param name: the name of the section;
+        :return: a sequence of the numbers of the section; if possible, the
+                 sequence is a view on the mapped file.
+        """
+        if name not in self._arrays:
+            typecode, itemsize, offset, length = self._sections[name]
+            if self._swap or not hasattr(memoryview, "cast"):
+                data = self._map[offset:offset + itemsize * length]
+                values = array.array(typecode)
+                if sys.version_info[0] < 3:
+                    values.fromstring(data)
+                else:
+                    values.frombytes(data)
+                if self._swap:
+                    values.byteswap()
+            else:
+                values = memoryview(self._map)[
+                    offset:offset + itemsize * length].cast(typecode)
+            self._arrays[name] = values
+        return self._arrays[name]
+
+    def alphabet(self):
+        """
+        Return the alphabet of this file and the index of each character.
+
+        :return: a (alphabet, index) pair, where alphabet is the list of
+                 characters and index the mapping of each character to its
+                 position in alphabet.
+        """
+        alphabet = [_chr(code) for code in self["alphabet"]]
+        return alphabet, {character: index
+                          for index, character in enumerate(alphabet)}
+
+    def corpus(self):
+        """
+        Return the corpus filter of this file.
+
+        :return: the Bloom filter of the corpus, reading the mapped bits, or
+                 None if the file has no corpus filter.
+        """
+        if "corpus_meta" not in self:
+            return None
+        size, hashes, count = self["corpus_meta"]
+        return BloomFilter(size, hashes, self["corpus_bits"], count)
+
+
+def _chr(code):
+    """
+    Return the character of the given code point.
+    """
+    return chr(code) if sys.version_info[0] >= 3 else unichr(code)
+
+
+class _Edges(Mapping):
+    """
+    A read-only mapping of characters to numbers, read from the flat arrays
+    of a binary file.
+    """
+
+    def __init__(self, alphabet, index, characters, values, start, end):
+        """
+        Create the mapping of characters[start:end] to values[start:end].
+
+        :param alphabet: the alphabet of the file;
+        :param index: the mapping of characters to their index in alphabet;
+        :param characters: the sorted character indices;
+        :param values: the values of the characters;
+        :param start: the offset of the first character of the mapping;
+        :param end: the offset after the last character of the mapping.
+        """
+        self._alphabet = alphabet
+        self._index = index
+        self._characters = characters
+        self._values = values
+        self._start = start
+        self._end = end
+
+    def _position(self, key):
+        character = self._index.get(key)
+        if character is not None:
+            position = bisect.bisect_left(self._characters, character,
+                                          self._start, self._end)
+            if (position < self._end and
+                    self._characters[position] == character):
+                return position
+        return None
+
+    def __getitem__(self, key):
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        return self._values[position]
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __iter__(self):
+        for position in range(self._start, self._end):
+            yield self._alphabet[self._characters[position]]
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __str__(self):
+        return str(dict(self))
+
+    __repr__ = __str__
+
+
+class _Nodes(object):
+    """
+    The read-only sequence of the edges of the nodes of a binary file.
+    """
+
+    def __init__(self, alphabet, index, offsets, characters, values):
+        """
+        Create the sequence of edges.
+
+        :param alphabet: the alphabet of the file;
+        :param index: the mapping of characters to their index in alphabet;
+        :param offsets: the offsets of the edges of each node;
+        :param characters: the character indices of the edges;
+        :param values: the values of the edges.
+        """
+        self._alphabet = alphabet
+        self._index = index
+        self._offsets = offsets
+        self._characters = characters
+        self._values = values
+
+    def __getitem__(self, node):
+        return _Edges(self._alphabet, self._index, self._characters,
+                      self._values, self._offsets[node],
+                      self._offsets[node + 1])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+class MappedTable(Table):
+    """
+    A read-only table read lazily from a memory-mapped binary file.
+    """
+
+    def __init__(self, storage):
+        """
+        Create the table of the given storage.
+
+        :param storage: the opened binary file.
+        """
+        self._storage = storage
+        self._reset_caches()
+        self.corpus = storage.corpus()
+        prefix, flatten, size = storage["meta"]
+        self.prefix = prefix
+        self.flatten = bool(flatten)
+        self._size = size
+        alphabet, index = storage.alphabet()
+        self._children = _Nodes(alphabet, index, storage["child_offsets"],
+                                storage["child_characters"],
+                                storage["children"])
+        self._successors = _Nodes(alphabet, index,
+                                  storage["successor_offsets"],
+                                  storage["successor_characters"],
+                                  storage["weights"])
+
+    def _child(self, node, character):
+        raise TypeError("memory-mapped tables cannot be modified")
+
+    def _add(self, node, successor, weight):
+        raise TypeError("memory-mapped tables cannot be modified")
+
+    def _remove(self, node, successor, weight):
+        raise TypeError("memory-mapped tables cannot be modified")
+
+    def prune(self, *args, **kwargs):
+        raise TypeError("memory-mapped tables cannot be modified")
+
+    def __reduce__(self):
+        return load, (self._storage.path,)
+
+
+class _Suffixes(object):
+    """
+    The read-only sequence of the suffixes of the nodes of a tree read from a
+    binary file.
+    """
+
+    def __init__(self, storage):
+        """
+        Create the sequence of suffixes of the given storage.
+
+        :param storage: the opened binary file.
+        """
+        self._alphabet = storage.alphabet()[0]
+        self._offsets = storage["string_offsets"]
+        self._characters = storage["string_characters"]
+        self._suffixes = storage["suffixes"]
+
+    def __getitem__(self, identifier):
+        string = self._suffixes[identifier]
+        start = self._offsets[string]
+        end = self._offsets[string + 1]
+        return "".join(self._alphabet[character]
+                       for character in self._characters[start:end])
+
+    def __len__(self):
+        return len(self._suffixes)
+
+
+class MappedTree(Tree):
+    """
+    A read-only tree read lazily from a memory-mapped binary file.
+    """
+
+    def __init__(self, storage):
+        """
+        Create the tree of the given storage.
+
+        :param storage: the opened binary file.
+        """
+        self._storage = storage
+        self.corpus = storage.corpus()
+        self._size = storage["meta"][0]
+        self._suffixes = _Suffixes(storage)
+        self._sizes = storage["sizes"]
+        self._offsets = storage["offsets"]
+        self._targets = storage["targets"]
+        self._characters = storage["characters"]
+        self._weights = storage["weights"]
+        self._probabilities = storage["probabilities"]
+        self._aliases = storage["aliases"]
+
+    def __reduce__(self):
+        return load, (self._storage.path,)
+
+
+# The number of records pickled together in temporary files
+_RECORDS_CHUNK = 1000
+# The maximum number of sorted runs merged at once
+_MERGE_FANIN = 64
+
+
+def _write_records(path, records):
+    """
+    Write the given records into a new temporary file at path.
+
+    :param path: the path of the file;
+    :param records: an iterable of picklable records;
+    :return: the number of written records.
+    """
+    count = 0
+    with open(path, "wb") as records_file:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) == _RECORDS_CHUNK:
+                pickle.dump(chunk, records_file, pickle.HIGHEST_PROTOCOL)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            pickle.dump(chunk, records_file, pickle.HIGHEST_PROTOCOL)
+            count += len(chunk)
+    return count
+
+
+def _read_records(path):
+    """
+    Return an iterator over the records of the temporary file at path.
+    """
+    with open(path, "rb") as records_file:
+        while True:
+            try:
+                chunk = pickle.load(records_file)
+            except EOFError:
+                return
+            for record in chunk:
+                yield record
+
+
+class _ExternalSort(object):
+    """
+    An external sort of distinct records: the records are sorted by runs of
+    at most run_size records, each run is written into a temporary file, and
+    the runs are merged into a sorted file without duplicates.
+    """
+
+    def __init__(self, directory, run_size):
+        """
+        Create a new empty sort.
+
+        :param directory: the directory of the temporary files;
+        :param run_size: the maximum number of records kept in memory.
+        """
+        self._directory = directory
+        self._run_size = run_size
+        self._runs = []
+        self._buffer = set()
+
+    def _path(self):
+        descriptor, path = tempfile.mkstemp(dir=self._directory)
+        os.close(descriptor)
+        return path
+
+    def _spill(self):
+        """
+        Write the records in memory as a new sorted run.
+        """
+        path = self._path()
+        _write_records(path, sorted(self._buffer))
+        self._runs.append(path)
+        self._buffer = set()
+        stats.count("tree.runs_spilled")
+
+    def add(self, record):
+        """
+        Add the given record to the sorted records.
+        """
+        self._buffer.add(record)
+        if len(self._buffer) >= self._run_size:
+            self._spill()
+
+    def _merge(self, runs, path):
+        """
+        Merge the given runs into the file at path, removing duplicates.
+
+        :return: the number of records of the merged file.
+        """
+        def distinct():
+            previous = None
+            for index, record in enumerate(heapq.merge(
+                    *[_read_records(run) for run in runs])):
+                if index == 0 or record != previous:
+                    yield record
+                previous = record
+
+        count = _write_records(path, distinct())
+        for run in runs:
+            os.remove(run)
+        return count
+
+    def finish(self, path):
+        """
+        Write the sorted distinct records into the file at path.
+
+        :param path: the path of the sorted file;
+        :return: the number of records of the sorted file.
+        """
+        if not self._runs:
+            return _write_records(path, sorted(self._buffer))
+        if self._buffer:
+            self._spill()
+        while len(self._runs) > _MERGE_FANIN:
+            runs = self._runs[:_MERGE_FANIN]
+            self._runs = self._runs[_MERGE_FANIN:]
+            merged = self._path()
+            self._merge(runs, merged)
+            self._runs.append(merged)
+        return self._merge(self._runs, path)
+
+
+class _SectionWriter(object):
+    """
+    A writer of the sections of a binary file whose lengths are known in
+    advance: the items of the sections are appended in any order, and
+    written at the position of their section when their buffer is full.
+    """
+
+    buffer_size = 1 << 16
+
+    def __init__(self, output, kind, sections):
+        """
+        Write the header and directory of the file into output.
+
+        :param output: the binary file object to write to; it must be
+                       seekable;
+        :param kind: the kind of content of the file;
+        :param sections: the list of the (name, typecode, length) triples of
+                         the sections of the file.
+        """
+        self._output = output
+        self._start = output.tell()
+        self._positions = {}
+        self._buffers = {}
+        for name, typecode, offset, _ in _write_directory(output, kind,
+                                                          sections):
+            self._positions[name] = self._start + offset
+            self._buffers[name] = array.array(typecode)
+        self._end = output.tell()
+
+    def _flush(self, name):
+        """
+        Write the buffered items of the given section.
+        """
+        buffer = self._buffers[name]
+        self._output.seek(self._positions[name])
+        self._output.write(_bytes(buffer))
+        self._positions[name] += buffer.itemsize * len(buffer)
+        self._end = max(self._end, self._positions[name])
+        del buffer[:]
+
+    def extend(self, name, values):
+        """
+        Append the given values to the section with the given name.
+        """
+        buffer = self._buffers[name]
+        buffer.extend(values)
+        if len(buffer) >= self.buffer_size:
+            self._flush(name)
+
+    def close(self):
+        """
+        Write the buffered items of all sections, and move to the end of the
+        written file.
+        """
+        for name in self._buffers:
+            self._flush(name)
+        self._output.seek(self._end)
+
+
+def build_tree(table, length, output, prefix=0, flatten=False,
+               memory=1 << 28, directory=None):
+    """
+    Build the tree extracted from table for word length, as Tree.from_table
+    does, and save it into output in the binary format, keeping about memory
+    bytes of nodes in memory at most.
+
+    :param table: the table to extract the tree from;
+    :param length: the length of words generated by the tree; >= 1;
+    :param output: the binary file object to write to; it must be seekable;
+    :param prefix: if greater than 0, the length of the prefixes used for
+                   computing successors;
+    :param flatten: whether to flatten the table or not;
+    :param memory: the approximate number of bytes of the nodes kept in
+                   memory;
+    :param directory: the directory of the temporary files (default: the
+                      default temporary directory).
+
+    The levels of the tree (the nodes of each size) are built one after the
+    other and written into temporary files: the successors of the nodes of a
+    level are sorted by runs and merged into the next level, with the
+    choices of each node. The dead nodes are then removed from the deepest
+    level up to the root, the live nodes of a level giving the position of
+    the live successors of the previous one. Finally, the sections of the
+    binary file are written level by level.
+
+    Without prefix, the successors of the nodes of a level come in the order
+    of the next level, and are found by a merge. With a prefix, the live
+    nodes of the next level are kept in memory to find them; their number is
+    bounded by the number of suffixes of prefix characters.
+    """
+    run_size = max(memory // EXPANDED_EDGE_BYTES, 1)
+    workspace = tempfile.mkdtemp(prefix="wagoner-", dir=directory)
+
+    def path(name, size):
+        return os.path.join(workspace, "%s-%d" % (name, size))
+
+    try:
+        # Build the levels, with the choices of their nodes
+        _write_records(path("nodes", 0), [">"])
+        expanded = []  # The number of nodes of each level
+        for size in range(length + 1):
+            successors = _ExternalSort(workspace, run_size)
+
+            def expand():
+                for suffix in _read_records(path("nodes", size)):
+                    if size == length:
+                        yield suffix, "<" in table.weighted_choices(
+                            suffix, flatten=flatten)
+                        continue
+                    choices = table.weighted_choices(suffix, exclude={"<"},
+                                                     flatten=flatten)
+                    for character in choices:
+                        expanded = suffix + character
+                        if prefix > 0:
+                            expanded = expanded[-prefix:]
+                        successors.add(expanded)
+                    yield suffix, sorted(choices.items())
+
+            expanded.append(_write_records(path("choices", size), expand()))
+            stats.count("tree.nodes_expanded", expanded[-1])
+            os.remove(path("nodes", size))
+            if size < length:
+                successors.finish(path("nodes", size + 1))
+
+        # Keep the live nodes, with the rank of their successors in the next
+        # level, from the deepest level up to the root
+        counts = [0] * (length + 1)
+        totals = [0, 0]  # The number of edges and characters of live nodes
+
+        def live(nodes):
+            for suffix, edges in nodes:
+                if edges:
+                    totals[0] += len(edges)
+                    totals[1] += len(suffix)
+                    yield suffix, edges
+
+        for size in range(length, -1, -1):
+            choices = _read_records(path("choices", size))
+            if size == length:
+                nodes = ((suffix, [("<", 1, 0)] if ending else [])
+                         for suffix, ending in choices)
+            else:
+                rank = _ranks(path("live", size + 1), prefix)
+                nodes = ((suffix, [(character, weight, target)
+                                   for character, weight in node_choices
+                                   for target in [rank(suffix, character)]
+                                   if target is not None])
+                         for suffix, node_choices in choices)
+            counts[size] = _write_records(path("live", size), live(nodes))
+            stats.count("tree.nodes_pruned", expanded[size] - counts[size])
+            os.remove(path("choices", size))
+
+        _write_tree(table, length, output, path, counts, totals[0],
+                    totals[1])
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def _ranks(path, prefix):
+    """
+    Return a function giving the rank, in the live nodes of the file at path,
+    of the successor of a suffix for a character, or None if this successor
+    is not live.
+
+    Without prefix, the successors must be asked in the order of the nodes;
+    with a prefix, the ranks of the live nodes are kept in memory.
+    """
+    nodes = (suffix for suffix, _ in _read_records(path))
+    if prefix > 0:
+        ranks = {suffix: index for index, suffix in enumerate(nodes)}
+        return lambda suffix, character: ranks.get(
+            (suffix + character)[-prefix:])
+    nodes = enumerate(nodes)
+    current = [next(nodes, (None, None))]
+
+    def rank(suffix, character):
+        target = suffix + character
+        index, node = current[0]
+        while node is not None and node < target:
+            index, node = current[0] = next(nodes, (None, None))
+        return index if node == target else None
+
+    return rank
+
+
+def _write_tree(table, length, output, path, counts, edges, characters):
+    """
+    Write the tree of the live nodes saved by build_tree into output.
+
+    :param table: the table the tree is extracted from;
+    :param length: the length of words generated by the tree;
+    :param output: the binary file object to write to;
+    :param path: the function giving the path of the live nodes of a level;
+    :param counts: the number of live nodes of each level;
+    :param edges: the number of edges of the live nodes;
+    :param characters: the number of characters of the suffixes of the live
+                       nodes.
+    """
+    alphabet, index = _alphabet(table._characters() + ["<"])
+    # The identifier of the first node of each level, and of the end node
+    firsts = [0]
+    for count in counts:
+        firsts.append(firsts[-1] + count)
+    nodes = firsts[-1] + 1 if counts[0] else 0
+    if nodes:
+        characters += 1  # The suffix of the end node
+    sections = [(name, values.typecode, len(values))
+                for name, values in _corpus_sections(table)]
+    sections += [
+        ("meta", _typecode(firsts[-1]), 1),
+        ("alphabet", _typecode(max(ord(c) for c in alphabet)),
+         len(alphabet)),
+        ("string_offsets", _typecode(characters), nodes + 1),
+        ("string_characters", _typecode(len(alphabet)), characters),
+        ("suffixes", _typecode(nodes), nodes),
+        ("sizes", _typecode(length + 1), nodes),
+        ("offsets", _typecode(edges), nodes + 1),
+        ("targets", _typecode(nodes), edges),
+        ("characters", _typecode(max(ord(c) for c in alphabet)), edges),
+        ("weights", "d", edges),
+        ("probabilities", "d", edges),
+        ("aliases", _typecode(len(alphabet)), edges)]
+    writer = _SectionWriter(output, TREE, sections)
+    for name, values in _corpus_sections(table):
+        writer.extend(name, values)
+    writer.extend("meta", [firsts[-1]])
+    writer.extend("alphabet", [ord(c) for c in alphabet])
+    writer.extend("string_offsets", [0])
+    writer.extend("offsets", [0])
+    position = edge = 0
+    identifier = 0
+    for size in range(length + 1 if nodes else 0):
+        for suffix, node_edges in _read_records(path("live", size)):
+            position += len(suffix)
+            writer.extend("string_characters", [index[character]
+                                                for character in suffix])
+            writer.extend("string_offsets", [position])
+            writer.extend("suffixes", [identifier])
+            writer.extend("sizes", [size])
+            total = sum(weight for _, weight, _ in node_edges)
+            weights = [weight / total for _, weight, _ in node_edges]
+            probabilities, aliases = alias_table(weights)
+            writer.extend("targets", [firsts[size + 1] + target
+                                      for _, _, target in node_edges])
+            writer.extend("characters", [ord(character)
+                                         for character, _, _ in node_edges])
+            writer.extend("weights", weights)
+            writer.extend("probabilities", probabilities)
+            writer.extend("aliases", aliases)
+            edge += len(node_edges)
+            writer.extend("offsets", [edge])
+            identifier += 1
+    if nodes:
+        # The end node, without successor
+        writer.extend("string_characters", [index["<"]])
+        writer.extend("string_offsets", [position + 1])
+        writer.extend("suffixes", [identifier])
+        writer.extend("sizes", [length + 1])
+        writer.extend("offsets", [edge])
+    writer.close()
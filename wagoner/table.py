@@ -6,16 +6,25 @@ a table. This table can then be used by the word module to generate random
 words.
 """
 
-from __future__ import print_function
+from __future__ import division, print_function
 import argparse
+import heapq
+import math
+import multiprocessing
 import pickle
-from collections import defaultdict, Mapping
+from collections import Counter, defaultdict, Mapping
 import random  # TODO Use cryptographic-friendly randomization
 import sys
 
 from wagoner.utils import *
+from wagoner import stats
 
-__all__ = ["Table"]
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+__all__ = ["Table", "MixedTable"]
 
 
 class Table(Mapping):
@@ -24,15 +33,59 @@ class Table(Mapping):
     with the weight of the corresponding character. That is, given t a table,
     t[s][c] gives the weight of c following s. Note that only non-zero weights
     are present.
+
+    The strings of a table are stored in a suffix trie: each node of the trie
+    is identified by an integer and represents the string spelled by the path
+    from the root (node 0) to it. Each node stores its children (a mapping of
+    characters to node identifiers) and its successors (a mapping of
+    characters to weights). Strings sharing a prefix thus share their nodes,
+    instead of being stored as separate keys.
+
+    The successors always store the number of occurrences of the characters;
+    if the table is flattened, the weights are all 1 when the table is read.
+
+    The contexts of a word are the nodes of its suffixes present in the trie;
+    the generation updates them at each added character. The samplers of the
+    weighted choices of the last used contexts are kept in a cache of
+    sampler_cache_size items, and reused by the generation. Similarly, the
+    last dead states found by the generation, that is, the contexts of the
+    words that cannot be extended to a given length, are kept in a cache of
+    dead_cache_size items. The batch samplers of the contexts met by
+    random_words are kept for the next calls, until they cover more than
+    sampler_cache_size contexts.
+
+    A table can also keep, in its corpus attribute, a Bloom filter of the
+    words it is built from (None by default), to tell whether generated words
+    are words of the corpus. update adds the words to this filter, but
+    remove cannot remove them from it.
     """
 
-    def __init__(self, table):
+    sampler_cache_size = 10000
+    dead_cache_size = 100000
+
+    def __init__(self, table=None, prefix=0, flatten=False):
         """
         Create a new table from table content.
 
-        :param table: the content of the new table.
+        :param table: the content of the new table, that is, a mapping of
+                      strings to mappings of successing characters and their
+                      weights; if None, the table is empty;
+        :param prefix: if greater than 0, the maximum length of the prefixes
+                       stored in the table;
+        :param flatten: whether the table is flattened or not.
         """
-        self.__content = table
+        self.prefix = prefix
+        self.flatten = flatten
+        self.corpus = None
+        self._children = [{}]
+        self._successors = [{}]
+        self._size = 0
+        self._reset_caches()
+        if table is not None:
+            for sub_word, successors in table.items():
+                node = self._insert(sub_word)
+                for successor, weight in successors.items():
+                    self._add(node, successor, weight)
 
     @classmethod
     def from_words(cls, words, prefix=0, flatten=False):
@@ -41,7 +94,10 @@ class Table(Mapping):
         The table is built by accumulating, for each word, for each sub-word,
         the number of occurrences of the corresponding next character.
         
-        :param words: an iterable of strings made of alphabetic characters;
+        :param words: an iterable of strings made of alphabetic characters,
+                      or a mapping of such strings to their number of
+                      occurrences (such as a Counter); the latter is faster
+                      if the words occur several times;
         :param prefix: if greater than 0, the maximum length of the prefix to
                        store in the table;
         :param flatten: whether to flatten the table or not;
@@ -52,31 +108,317 @@ class Table(Mapping):
         {'a':{'b': 1, 'q': 1}, 'ab': {'a': 1}, 'aba': {'q': 1}, 'b': {'a': 1},
          'ba': {'q': 1}}
         """
-        table = defaultdict(lambda: defaultdict(int))
-        for word in words:
+        return cls(prefix=prefix, flatten=flatten).update(words)
+
+    def update(self, words):
+        """
+        Add the occurrences of the sub-words of the given words to this table,
+        as if the table were built from its words and these ones. The prefix
+        and flatten of this table are kept.
+
+        :param words: an iterable of strings made of alphabetic characters,
+                      or a mapping of such strings to their number of
+                      occurrences;
+        :return: this table.
+        """
+        self._reset_caches()
+        prefix = self.prefix
+        corpus = self.corpus
+        counts = (words.items() if isinstance(words, Mapping)
+                  else ((word, 1) for word in words))
+        for word, count in counts:
+            if corpus is not None:
+                corpus.add(word)
             word = ">" + word + "<"
             for start in range(len(word) - 1):
                 max_end = ((len(word) - 1) if prefix <= 0
                            else (min(start + prefix + 1, len(word) - 1)))
+                node = 0
                 for end in range(start + 1, max_end + 1):
-                    sub_word = word[start:end]
-                    weight = 1 if flatten else (table[sub_word][word[end]] + 1)
-                    table[sub_word][word[end]] = weight
-        for k, v in table.items():
-            table[k] = dict(v)
-        return cls(dict(table))
+                    node = self._child(node, word[end - 1])
+                    self._add(node, word[end], count)
+        return self
+
+    def remove(self, words):
+        """
+        Remove the occurrences of the sub-words of the given words from this
+        table, as if the table were built from its words without these ones.
+        The successors whose weight drops to 0 are removed.
+
+        :param words: an iterable of strings made of alphabetic characters,
+                      or a mapping of such strings to their number of
+                      occurrences; they must have been added to this table
+                      before;
+        :return: this table.
+        :raises ValueError: if the words were not all added to this table; in
+                            this case, the table is left unchanged.
+        """
+        other = type(self).from_words(words, prefix=self.prefix,
+                                      flatten=self.flatten)
+        updates = []
+        pending = [(0, 0)]
+        while pending:
+            node, other_node = pending.pop()
+            if node is None:
+                raise ValueError("cannot remove words that are not in the "
+                                 "table")
+            successors = self._successors[node]
+            for successor, weight in other._successors[other_node].items():
+                if successors.get(successor, 0) < weight:
+                    raise ValueError("cannot remove words that are not in "
+                                     "the table")
+                updates.append((node, successor, weight))
+            for character, child in other._children[other_node].items():
+                pending.append((self._children[node].get(character), child))
+        self._reset_caches()
+        for node, successor, weight in updates:
+            self._remove(node, successor, weight)
+        return self
+
+    def merge(self, other):
+        """
+        Add the weights of other to the weights of this table.
+
+        :param other: the table to merge into this one; it must be built with
+                      the same prefix and flatten as this table;
+        :return: this table.
+        :raises ValueError: if other is not built with the same prefix and
+                            flatten as this table.
+
+        The corpus filter of other is merged into the one of this table if
+        they have the same size; otherwise, this table loses its filter, as
+        the words of other cannot be added to it.
+        """
+        if other.prefix != self.prefix or other.flatten != self.flatten:
+            raise ValueError("cannot merge tables built with different "
+                             "prefix or flatten")
+        self._merge_corpus(other)
+        self._reset_caches()
+        pending = [(0, 0)]
+        while pending:
+            node, other_node = pending.pop()
+            for successor, weight in other._successors[other_node].items():
+                self._add(node, successor, weight)
+            for character, child in other._children[other_node].items():
+                pending.append((self._child(node, character), child))
+        return self
+
+    def _merge_corpus(self, other):
+        """
+        Merge the corpus filter of other into the one of this table, before
+        merging other into this table. See merge.
+        """
+        other_corpus = getattr(other, "corpus", None)
+        if self.corpus is None and not self._size and other_corpus is not None:
+            self.corpus = other_corpus.copy()
+        elif (self.corpus is not None and other_corpus is not None and
+              (other_corpus.size, other_corpus.hashes) ==
+              (self.corpus.size, self.corpus.hashes)):
+            self.corpus.merge(other_corpus)
+        elif self.corpus is not None and len(other):
+            # The words of other cannot be added to the filter
+            self.corpus = None
+
+    def __add__(self, other):
+        if not isinstance(other, Table):
+            return NotImplemented
+        # The sum is a new table in memory, whatever the kind of self
+        table = Table(prefix=self.prefix, flatten=self.flatten)
+        return table.merge(self).merge(other)
+
+    def _child(self, node, character):
+        """
+        Return the child of node for character, creating it if needed.
+
+        :param node: the identifier of the parent node;
+        :param character: the character labelling the edge to the child;
+        :return: the identifier of the child.
+        """
+        children = self._children[node]
+        child = children.get(character)
+        if child is None:
+            child = len(self._children)
+            children[character] = child
+            self._children.append({})
+            self._successors.append({})
+        return child
+
+    def _insert(self, sub_word):
+        """
+        Return the node of sub_word, creating the nodes of its path if needed.
+
+        :param sub_word: the string to insert;
+        :return: the identifier of the node of sub_word.
+        """
+        node = 0
+        for character in sub_word:
+            node = self._child(node, character)
+        return node
+
+    def _find(self, sub_word):
+        """
+        Return the node of sub_word, or None if sub_word is not in the trie.
+
+        :param sub_word: the string to look for;
+        :return: the identifier of the node of sub_word, or None.
+        """
+        node = 0
+        for character in sub_word:
+            node = self._children[node].get(character)
+            if node is None:
+                return None
+        return node
+
+    def _advance(self, contexts, character, prefix=0):
+        """
+        Return the contexts of a word extended with character, given the
+        contexts of the word.
+
+        :param contexts: the contexts of the word, as returned by _contexts;
+        :param character: the character extending the word;
+        :param prefix: if greater than 0, the maximum length of the contexts;
+        :return: the contexts of the word extended with character.
+
+        The suffixes of the extended word are the suffixes of the word
+        extended with character, and character itself; the nodes of the
+        extended suffixes are thus the children of the nodes of the word,
+        and no string is built or looked up from the root.
+        """
+        children = self._children
+        advanced = []
+        node = children[0].get(character)
+        if node is not None:
+            advanced.append((node, 1))
+        for node, depth in contexts:
+            if prefix > 0 and depth >= prefix:
+                break
+            child = children[node].get(character)
+            if child is not None:
+                advanced.append((child, depth + 1))
+        return tuple(advanced)
+
+    def _contexts(self, word, prefix=0):
+        """
+        Return the contexts of word, that is, the (node, length) pairs of the
+        non-empty suffixes of word present in the trie, from the shortest to
+        the longest.
+
+        :param word: the word (as a string);
+        :param prefix: if greater than 0, the maximum length of the contexts;
+        :return: the contexts of word, as a tuple.
+        """
+        contexts = ()
+        for character in word:
+            contexts = self._advance(contexts, character, prefix=prefix)
+        return contexts
+
+    def _ends(self, contexts):
+        """
+        Return whether a word of the given contexts ends as a word of this
+        table, that is, whether its last character can be followed by "<".
+        """
+        return (bool(contexts) and contexts[0][1] == 1 and
+                "<" in self._successors[contexts[0][0]])
+
+    def _characters(self):
+        """
+        Return the characters of this table, that is, the characters its
+        strings are made of (with > but without <), as a list.
+        """
+        return list(self._children[0])
+
+    def _first_letters(self):
+        """
+        Return the characters that can start a word generated from this
+        table, that is, the characters (but >) that can be followed by
+        another one, as a list.
+        """
+        return [character for character, node in self._children[0].items()
+                if character != ">" and self._successors[node]]
+
+    def _add(self, node, successor, weight):
+        """
+        Add weight to the weight of successor following the string of node.
+
+        :param node: the identifier of the node;
+        :param successor: the successing character;
+        :param weight: the weight to add.
+        """
+        successors = self._successors[node]
+        if not successors:
+            self._size += 1
+        successors[successor] = successors.get(successor, 0) + weight
+
+    def _remove(self, node, successor, weight):
+        """
+        Remove weight from the weight of successor following the string of
+        node, removing successor if its weight drops to 0.
+
+        :param node: the identifier of the node;
+        :param successor: the successing character;
+        :param weight: the weight to remove; at most the current weight.
+        """
+        successors = self._successors[node]
+        if successors[successor] > weight:
+            successors[successor] -= weight
+        else:
+            del successors[successor]
+            if not successors:
+                self._size -= 1
 
     def __getitem__(self, key):
-        return self.__content[key]
+        node = self._find(key)
+        if node is None or not self._successors[node]:
+            raise KeyError(key)
+        if self.flatten:
+            return dict.fromkeys(self._successors[node], 1)
+        return self._successors[node]
+
+    def __contains__(self, key):
+        node = self._find(key)
+        return node is not None and bool(self._successors[node])
 
     def __iter__(self):
-        return iter(self.__content)
+        pending = [(0, "")]
+        while pending:
+            node, sub_word = pending.pop()
+            if self._successors[node]:
+                yield sub_word
+            for character, child in self._children[node].items():
+                pending.append((child, sub_word + character))
 
     def __len__(self):
-        return len(self.__content)
+        return self._size
 
     def __str__(self):
-        return str(self.__content)
+        return str({sub_word: self[sub_word] for sub_word in self})
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_samplers"]
+        del state["_dead"]
+        del state["_batches"]
+        return state
+
+    def __setstate__(self, state):
+        if "_Table__content" in state:
+            # Table pickled before the suffix trie
+            self.__init__(state["_Table__content"])
+        else:
+            state.setdefault("prefix", 0)
+            state.setdefault("flatten", False)
+            state.setdefault("corpus", None)
+            self.__dict__.update(state)
+            self._reset_caches()
+
+    def _reset_caches(self):
+        """
+        Empty the caches of samplers, batch samplers and dead states of this
+        table.
+        """
+        self._samplers = LRUCache(self.sampler_cache_size)
+        self._dead = LRUCache(self.dead_cache_size)
+        self._batches = {}
 
     def check(self):
         """
@@ -91,6 +433,133 @@ class Table(Mapping):
                     return False
         return True
 
+    def _distribution(self, word):
+        """
+        Return the probabilities of the choices for word from this table.
+
+        :param word: the word (as a string);
+        :return: a dictionary of the choices for word and their probabilities.
+        """
+        choices = self.weighted_choices(word)
+        total = sum(choices.values())
+        return {choice: weight / total for choice, weight in choices.items()}
+
+    def prune(self, min_count=0, max_contexts=None, max_kl=None,
+              min_weight=0):
+        """
+        Remove from this table the rare or redundant strings (the contexts of
+        the successors) and the successors of low weight.
+
+        :param min_count: the minimum number of occurrences of the contexts
+                          to keep;
+        :param max_contexts: if not None, the maximum number of contexts to
+                             keep;
+        :param max_kl: if not None, the contexts whose choices diverge from
+                       the choices of their longest proper suffix by at most
+                       max_kl (Kullback-Leibler divergence, in nats) are
+                       removed;
+        :param min_weight: the minimum weight of the successors to keep; the
+                           heaviest successor of each context is always kept;
+        :return: a report of the pruning, that is, a dictionary giving the
+                 number of contexts and successors before and after the
+                 pruning ("contexts" and "successors", as pairs), and the
+                 mean and maximum distances between the choices of the
+                 contexts before and after the pruning ("mean_distance" and
+                 "max_distance"); the distances are total variation distances
+                 and the mean is weighted by the occurrences of the contexts.
+
+        Contexts of one character are never removed, and each kept context
+        keeps at least its heaviest successor (the greatest one among the
+        heaviest), such that every kept context still has a successor, and
+        every successor (but <, the end of words) of a kept context is still
+        a context. The other contexts are removed from the longest ones: a
+        context is only removed if no longer context ends with it, and the
+        choices of the words ending with it then fall back to the choices of
+        its suffix. If there are still more than max_contexts contexts, the
+        contexts with the lowest divergence (weighted by their occurrences)
+        are removed first.
+        """
+        contexts = {}
+        for sub_word in self:
+            contexts[sub_word] = dict(self._successors[self._find(sub_word)])
+        totals = {sub_word: sum(successors.values())
+                  for sub_word, successors in contexts.items()}
+        original = {sub_word: self._distribution(sub_word)
+                    for sub_word in contexts}
+
+        def divergence(sub_word):
+            # The choices of the suffix include the ones of sub_word
+            fallback = original[sub_word[1:]]
+            return sum(probability * math.log(probability /
+                                              fallback[choice])
+                       for choice, probability
+                       in original[sub_word].items())
+
+        kept = set(contexts)
+        # The number of kept contexts extending each context by one character
+        extensions = Counter(sub_word[1:] for sub_word in contexts
+                             if len(sub_word) > 1)
+        leaves = [sub_word for sub_word in contexts
+                  if len(sub_word) > 1 and not extensions[sub_word]]
+        scores = []  # The heap of the kept leaves, by weighted divergence
+
+        def remove(sub_word):
+            kept.discard(sub_word)
+            suffix = sub_word[1:]
+            extensions[suffix] -= 1
+            if len(suffix) > 1 and not extensions[suffix]:
+                leaves.append(suffix)
+
+        def visit():
+            # Remove the rare or redundant leaves, and keep the others
+            while leaves:
+                sub_word = leaves.pop()
+                score = divergence(sub_word)
+                if (totals[sub_word] < min_count or
+                        (max_kl is not None and score <= max_kl)):
+                    remove(sub_word)
+                else:
+                    heapq.heappush(scores,
+                                   (totals[sub_word] * score, sub_word))
+
+        visit()
+        if max_contexts is not None:
+            while len(kept) > max_contexts and scores:
+                remove(heapq.heappop(scores)[1])
+                visit()
+
+        # Rebuild the trie with the kept contexts and successors
+        self._reset_caches()
+        self._children = [{}]
+        self._successors = [{}]
+        self._size = 0
+        for sub_word, successors in contexts.items():
+            if sub_word not in kept:
+                continue
+            heaviest = max(successors, key=lambda successor:
+                           (successors[successor], successor))
+            node = self._insert(sub_word)
+            for successor, weight in successors.items():
+                if weight >= min_weight or successor == heaviest:
+                    self._add(node, successor, weight)
+
+        distances = {}
+        for sub_word in contexts:
+            pruned = self._distribution(sub_word)
+            choices = set(original[sub_word]) | set(pruned)
+            distances[sub_word] = sum(abs(original[sub_word].get(choice, 0) -
+                                          pruned.get(choice, 0))
+                                      for choice in choices) / 2
+        total = sum(totals.values())
+        return {"contexts": (len(contexts), len(self)),
+                "successors": (sum(len(successors)
+                                   for successors in contexts.values()),
+                               sum(len(self[sub_word]) for sub_word in self)),
+                "mean_distance": (sum(distances[sub_word] * totals[sub_word]
+                                      for sub_word in contexts) / total
+                                  if total else 0),
+                "max_distance": max(distances.values()) if distances else 0}
+
     def weighted_choices(self, word, exclude=None, flatten=False):
         """
         Return the weighted choices for word from this table.
@@ -98,7 +567,8 @@ class Table(Mapping):
         :param word: the word (as a string);
         :param exclude: if not None, a set of characters to exclude from the
                         weighted choices;
-        :param flatten: whether or not consider this table as flattened;
+        :param flatten: whether or not consider this table as flattened; a
+                        flattened table is always considered as such;
         :return: the weighted choices for word from this table.
         
         The weighted choices are computed such that:
@@ -110,22 +580,64 @@ class Table(Mapping):
           scaled up weights to assure that all shorter suffixes will have less
           probabilities to be picked.
         """
+        return self._weighted_choices(self._contexts(word), exclude=exclude,
+                                      flatten=flatten)
+
+    def _weighted_choices(self, contexts, exclude=None, flatten=False):
+        """
+        Return the weighted choices for a word of the given contexts. See
+        weighted_choices for the arguments.
+        """
         exclude = exclude if exclude is not None else set()
+        flatten = flatten or self.flatten
         weighted_choices = defaultdict(int)
         total_sum = 1
-        for start in range(len(word) - 1, -1, -1):
+        for node, _ in contexts:
             current_sum = 0
-            sub_word = word[start:]
-            if sub_word in self:
-                for successor, weight in self[sub_word].items():
-                    if successor not in exclude:
-                        weight = 1 if flatten else weight
-                        weight = weight * total_sum
-                        weighted_choices[successor] += weight
-                        current_sum += weight
+            for successor, weight in self._successors[node].items():
+                if successor not in exclude:
+                    weight = 1 if flatten else weight
+                    weight = weight * total_sum
+                    weighted_choices[successor] += weight
+                    current_sum += weight
             total_sum += current_sum
+        stats.count("table.weighted_choices")
+        stats.count("table.suffixes_scanned", len(contexts))
         return weighted_choices
 
+    def sampler(self, word, exclude=None, flatten=False):
+        """
+        Return a sampler of the weighted choices for word from this table.
+
+        :param word: the word (as a string);
+        :param exclude: if not None, a set of characters to exclude from the
+                        weighted choices;
+        :param flatten: whether or not consider this table as flattened;
+        :return: a sampler of the weighted choices for word from this table.
+
+        The samplers are cached by contexts, such that the weighted choices of
+        the words sharing the same contexts are only computed once as long as
+        these contexts are used.
+        """
+        return self._sampler(self._contexts(word), exclude=exclude,
+                             flatten=flatten)
+
+    def _sampler(self, contexts, exclude=None, flatten=False):
+        """
+        Return a sampler of the weighted choices for a word of the given
+        contexts. See sampler for the arguments.
+        """
+        key = (contexts, frozenset(exclude) if exclude else frozenset(),
+               flatten or self.flatten)
+        sampler = self._samplers.get(key)
+        if sampler is None:
+            stats.count("table.sampler_cache_misses")
+            sampler = Sampler(self._weighted_choices(contexts,
+                                                     exclude=exclude,
+                                                     flatten=flatten))
+            self._samplers[key] = sampler
+        return sampler
+
     def random_word(self, length, prefix=0, start=False, end=False,
                     flatten=False):
         """
@@ -146,7 +658,7 @@ class Table(Mapping):
             return self._extend_word(word, length, prefix=prefix, end=end,
                                      flatten=flatten)[1:]
         else:
-            first_letters = list(k for k in self if len(k) == 1 and k != ">")
+            first_letters = self._first_letters()
             while True:
                 word = random.choice(first_letters)
                 try:
@@ -154,8 +666,100 @@ class Table(Mapping):
                                              end=end, flatten=flatten)
                     return word
                 except GenerationError:
+                    stats.count("table.restarts")
                     first_letters.remove(word[0])
 
+    def random_words(self, count, length, prefix=0, start=False, end=False,
+                     flatten=False):
+        """
+        Generate count random words of length from this table.
+
+        :param count: the number of words to generate;
+        :param length: the length of the generated words; >= 1;
+        :param prefix: if greater than 0, the maximum length of the prefix to
+                       consider to choose the next character;
+        :param start: if True, the generated words start as words of table;
+        :param end: if True, the generated words end as words of table;
+        :param flatten: whether or not consider the table as flattened;
+        :return: a list of count random words of length generated from table.
+        :raises GenerationError: if no word of length can be generated.
+
+        If NumPy is available and end is False, the words are generated
+        together, one character at a time: the random numbers are drawn for
+        all words at once, and the characters are chosen with a batch sampler
+        over the contexts of the words. The few words that cannot be extended
+        are generated again with random_word. Otherwise, the words are
+        generated one by one with random_word.
+        """
+        if numpy is None or end:
+            return [self.random_word(length, prefix=prefix, start=start,
+                                     end=end, flatten=flatten)
+                    for _ in range(count)]
+        if count == 0:
+            return []
+
+        # The states are kept for the next calls, unless there are too many
+        batch = self._batches.get((prefix, flatten))
+        if batch is None or len(batch[3]) > self.sampler_cache_size:
+            alphabet = self._characters()
+            batch = (alphabet,
+                     {character: index
+                      for index, character in enumerate(alphabet)},
+                     BatchSampler(),
+                     [],  # The contexts of each state
+                     {})  # The state of each contexts
+            self._batches[(prefix, flatten)] = batch
+        alphabet, letters, sampler, contexts, states = batch
+
+        def state(context):
+            if context not in states:
+                choices = self._weighted_choices(context, exclude={"<"},
+                                                 flatten=flatten)
+                states[context] = sampler.add([(letters[c], weight)
+                                               for c, weight
+                                               in choices.items()])
+                contexts.append(context)
+            return states[context]
+
+        words = numpy.zeros((count, length), dtype=numpy.int64)
+        if start:
+            current = numpy.full(count, state(self._contexts(">")),
+                                 dtype=numpy.int64)
+            first = 0
+        else:
+            first_letters = self._first_letters()
+            first_states = numpy.array([state(self._contexts(letter))
+                                        for letter in first_letters])
+            first_indices = numpy.array([letters[letter]
+                                         for letter in first_letters])
+            drawn = numpy.random.randint(len(first_letters), size=count)
+            words[:, 0] = first_indices[drawn]
+            current = first_states[drawn]
+            first = 1
+        failed = numpy.zeros(count, dtype=bool)
+        for position in range(first, length):
+            failed |= sampler.empty(current)
+            alive = numpy.flatnonzero(~failed)
+            characters = sampler.choose(current[alive])
+            words[alive, position] = characters
+            if position < length - 1:
+                # Move to the states of the extended contexts
+                pairs = current[alive] * len(alphabet) + characters
+                unique, inverse = numpy.unique(pairs, return_inverse=True)
+                targets = numpy.array([state(self._advance(
+                                           contexts[pair // len(alphabet)],
+                                           alphabet[pair % len(alphabet)],
+                                           prefix=prefix))
+                                       for pair in unique.tolist()])
+                current[alive] = targets[inverse.ravel()]
+
+        words = numpy.array(alphabet)[words].view("U%d" % length).ravel()
+        words = words.tolist()
+        for index in numpy.flatnonzero(failed).tolist():
+            words[index] = self.random_word(length, prefix=prefix,
+                                            start=start, flatten=flatten)
+        return words
+
     def _extend_word(self, word, length, prefix=0, end=False, flatten=False):
         """
         Extend the given word with a random suffix up to length.
@@ -168,32 +772,294 @@ class Table(Mapping):
         :return: a random word of length generated from table, extending word.
         :raises GenerationError: if the generated word cannot be extended to
                                  length.
+
+        The word is extended one character at a time; when the current word
+        cannot be extended, its last character is excluded and another one is
+        chosen. The contexts of the word (the nodes of its suffixes) are
+        updated at each added character, instead of being looked up again.
+        The states (the contexts of the word and the number of characters
+        still to add) that cannot be extended are remembered, such that they
+        are never extended again.
         """
+        def state(contexts, remaining):
+            return contexts, remaining, prefix, end
+
+        contexts = self._contexts(word, prefix=prefix)
         if len(word) == length:
-            if end and "<" not in self[word[-1]]:
+            if end and not self._ends(contexts):
+                stats.count("table.generation_errors")
                 raise GenerationError(word + " cannot be extended")
             else:
                 return word
-        else:  # len(word) < length
-            exclude = {"<"}
-            while True:
-                choices = self.weighted_choices(word[-prefix
-                                                     if prefix > 0
-                                                     else 0:],
-                                                exclude=exclude,
-                                                flatten=flatten)
-                if not choices:
-                    raise GenerationError(word + " cannot be extended")
-                # Extend with the weighted choice
-                character = random_weighted_choice(choices)
-                word += character
-                try:
-                    word = self._extend_word(word, length, prefix=prefix,
-                                             end=end, flatten=flatten)
-                    return word
-                except GenerationError:
+        if state(contexts, length - len(word)) in self._dead:
+            stats.count("table.generation_errors")
+            raise GenerationError(word + " cannot be extended")
+        characters = list(word)
+        start = len(characters)
+        path = [contexts]  # The contexts after each prefix
+        excluded = [{"<"}]  # The excluded characters after each prefix
+        while True:
+            contexts = path[-1]
+            exclude = excluded[-1]
+            choices = self._sampler(contexts, exclude=exclude, flatten=flatten)
+            if not choices:
+                # No character can extend the word, backtrack
+                self._dead[state(contexts, length - len(characters))] = True
+                if len(characters) == start:
+                    stats.count("table.generation_errors")
+                    raise GenerationError("".join(characters) +
+                                          " cannot be extended")
+                stats.count("table.backtracks")
+                path.pop()
+                excluded.pop()
+                excluded[-1].add(characters.pop())
+                continue
+            # Extend with the weighted choice
+            character = random_weighted_choice(choices)
+            extended = self._advance(contexts, character, prefix=prefix)
+            remaining = length - len(characters) - 1
+            if remaining == 0:
+                if end and not self._ends(extended):
+                    stats.count("table.backtracks")
+                    self._dead[state(extended, remaining)] = True
                     exclude.add(character)
-                    word = word[:-1]
+                else:
+                    characters.append(character)
+                    return "".join(characters)
+            elif state(extended, remaining) in self._dead:
+                stats.count("table.dead_states_skipped")
+                exclude.add(character)
+            else:
+                characters.append(character)
+                path.append(extended)
+                excluded.append({"<"})
+
+
+class MixedTable(Table):
+    """
+    A mixed table is a read-only weighted mixture of tables, generating words
+    from a blend of their corpora without building a new table. The weighted
+    choices for a word are the mixture of the weighted choices of the tables:
+    the choices of each table are normalized, then weighted by the weight of
+    the table, such that the weight of a table is its share of the choices,
+    whatever the size of its corpus.
+
+    The mixed table shares the nodes of its tables: the contexts of a word
+    are the tuple of its contexts in each table, and the weighted choices are
+    mixed on demand. The mixed choices of the last used contexts are kept in
+    a cache of sampler_cache_size items.
+
+    The tables of a mixed table must not be modified while it is used.
+    """
+
+    def __init__(self, tables, weights=None):
+        """
+        Create a new mixture of tables.
+
+        :param tables: the tables to mix;
+        :param weights: if not None, the weight of each table (positive
+                        numbers); if None, the tables are equally weighted.
+        :raises ValueError: if there is no table, if the number of weights is
+                            not the number of tables, or if a weight is
+                            negative or all weights are 0.
+        """
+        tables = list(tables)
+        weights = [1] * len(tables) if weights is None else list(weights)
+        if not tables:
+            raise ValueError("a mixed table needs at least one table")
+        if len(weights) != len(tables):
+            raise ValueError("a mixed table needs one weight per table")
+        if any(weight < 0 for weight in weights) or not sum(weights):
+            raise ValueError("the weights of a mixed table must be positive")
+        self.tables = tables
+        self.weights = weights
+        total = sum(weights)
+        self._components = [(table, weight / total)
+                            for table, weight in zip(tables, weights)
+                            if weight > 0]
+        prefixes = [table.prefix for table, _ in self._components]
+        self.prefix = 0 if 0 in prefixes else max(prefixes)
+        self.flatten = False
+        self._corpus = None
+        self._reset_caches()
+
+    @property
+    def corpus(self):
+        """
+        The Bloom filter of the words of the mixed tables, or None if some
+        table has no filter, or if their filters have different sizes.
+        """
+        if self._corpus is None:
+            corpora = [getattr(table, "corpus", None)
+                       for table, _ in self._components]
+            if None in corpora or len({(corpus.size, corpus.hashes)
+                                       for corpus in corpora}) > 1:
+                return None
+            self._corpus = corpora[0].copy()
+            for corpus in corpora[1:]:
+                self._corpus.merge(corpus)
+        return self._corpus
+
+    def update(self, words):
+        raise TypeError("mixed tables cannot be modified")
+
+    def remove(self, words):
+        raise TypeError("mixed tables cannot be modified")
+
+    def merge(self, other):
+        raise TypeError("mixed tables cannot be modified")
+
+    def prune(self, *args, **kwargs):
+        raise TypeError("mixed tables cannot be modified")
+
+    def __add__(self, other):
+        return NotImplemented
+
+    def _advance(self, contexts, character, prefix=0):
+        return tuple(table._advance(table_contexts, character, prefix=prefix)
+                     for (table, _), table_contexts
+                     in zip(self._components, contexts))
+
+    def _contexts(self, word, prefix=0):
+        return tuple(table._contexts(word, prefix=prefix)
+                     for table, _ in self._components)
+
+    def _ends(self, contexts):
+        return any(table._ends(table_contexts)
+                   for (table, _), table_contexts
+                   in zip(self._components, contexts))
+
+    def _characters(self):
+        characters = []
+        for table, _ in self._components:
+            characters.extend(character
+                              for character in table._characters()
+                              if character not in characters)
+        return characters
+
+    def _first_letters(self):
+        letters = []
+        for table, _ in self._components:
+            letters.extend(letter for letter in table._first_letters()
+                           if letter not in letters)
+        return letters
+
+    def __getitem__(self, key):
+        successors = defaultdict(float)
+        for table, weight in self._components:
+            if key in table:
+                table_successors = table[key]
+                total = sum(table_successors.values())
+                for successor, count in table_successors.items():
+                    successors[successor] += weight * count / total
+        if not successors:
+            raise KeyError(key)
+        return dict(successors)
+
+    def __contains__(self, key):
+        return any(key in table for table, _ in self._components)
+
+    def __iter__(self):
+        seen = set()
+        for table, _ in self._components:
+            for sub_word in table:
+                if sub_word not in seen:
+                    seen.add(sub_word)
+                    yield sub_word
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_samplers"]
+        del state["_dead"]
+        del state["_batches"]
+        del state["_choices"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_caches()
+
+    def _reset_caches(self):
+        """
+        Empty the caches of mixed choices, samplers, batch samplers and dead
+        states of this table.
+        """
+        super(MixedTable, self)._reset_caches()
+        self._choices = LRUCache(self.sampler_cache_size)
+
+    def _weighted_choices(self, contexts, exclude=None, flatten=False):
+        """
+        Return the weighted choices for a word of the given contexts, mixed
+        from the weighted choices of the tables. See weighted_choices for the
+        arguments; the returned choices must not be modified.
+        """
+        key = (contexts, frozenset(exclude) if exclude else frozenset(),
+               flatten)
+        choices = self._choices.get(key)
+        if choices is None:
+            stats.count("mixed_table.choices_cache_misses")
+            mixed = defaultdict(float)
+            for (table, weight), table_contexts in zip(self._components,
+                                                       contexts):
+                table_choices = table._weighted_choices(table_contexts,
+                                                        exclude=exclude,
+                                                        flatten=flatten)
+                total = sum(table_choices.values())
+                for choice, count in table_choices.items():
+                    mixed[choice] += weight * count / total
+            choices = self._choices[key] = dict(mixed)
+        return choices
+
+
+def _chunk_table(chunk):
+    """
+    Return the table of the words of the given chunk of a text.
+
+    :param chunk: a (path, start, end, encoding, prefix, flatten, lower,
+                  normalization) tuple, where start and end are the byte
+                  offsets of the chunk;
+    :return: the table of the words of the lines starting in the chunk.
+    """
+    path, start, end, encoding, prefix, flatten, lower, normalization = chunk
+    words = extract_block_words(read_blocks(path, start, end,
+                                            encoding=encoding),
+                                lower=lower, normalization=normalization)
+    return Table.from_words(Counter(words), prefix=prefix, flatten=flatten)
+
+
+def parallel_table(path, jobs, prefix=0, flatten=False, encoding=None,
+                   lower=False, normalization=None):
+    """
+    Build the table of the words of the text at path with jobs processes.
+    The text is split into chunks, the table of each chunk is built by a
+    process, and the partial tables are merged.
+
+    :param path: the path of the text;
+    :param jobs: the number of processes; >= 1;
+    :param prefix: if greater than 0, the maximum length of the prefix to
+                   store in the table;
+    :param flatten: whether to flatten the table or not;
+    :param encoding: the encoding of the text (default: UTF-8);
+    :param lower: whether to lowercase the words of the text;
+    :param normalization: if not None, the Unicode normalization form of the
+                          words of the text;
+    :return: the table of the words of the text.
+    """
+    chunks = [(path, start, end, encoding, prefix, flatten, lower,
+               normalization)
+              for start, end in file_chunks(path, jobs * 4)]
+    table = Table(prefix=prefix, flatten=flatten)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for partial in pool.imap_unordered(_chunk_table, chunks):
+            table.merge(partial)
+    finally:
+        pool.close()
+        pool.join()
+    return table
 
 
 def process_arguments():
@@ -201,7 +1067,26 @@ def process_arguments():
     Process the command line arguments. The arguments are:
      * the list of texts to analyse (at least one);
      * -f (or --flatten) if the table must be flattened;
-     * -o (or --output) the output file (default: stdout).
+     * --dense if the table must be stored as dense arrays (needs a prefix
+       and NumPy);
+     * --lower if the words must be lowercased;
+     * --filter if a Bloom filter of the words must be kept in the table;
+     * --error-rate for the false positive rate of the filter
+       (default: 0.01);
+     * --min-count for the minimum number of occurrences of the contexts;
+     * --max-contexts for the maximum number of contexts;
+     * --max-kl for the maximum divergence of the removed contexts;
+     * --min-weight for the minimum weight of the successors;
+     * --normalize for the Unicode normalization form of the words;
+     * -j (or --jobs) the number of processes building the table (default: 1);
+     * -u (or --update) a table file to update with the text instead of
+       building a new table;
+     * -r (or --remove) if the text must be removed from the updated table;
+     * -o (or --output) the output file (default: stdout, or the updated
+       table file);
+     * --format the format of the output file (default: pickle, or the
+       format of the updated table file);
+     * --stats if statistics must be printed (on stderr).
     """
     parser = argparse.ArgumentParser(description="Extract a table from the "
                                                  "given text")
@@ -214,25 +1099,171 @@ def process_arguments():
                                             "(default: 0)")
     parser.add_argument("--flatten", "-f", action="store_true", default=False,
                         dest="flatten", help="flatten the table")
+    parser.add_argument("--dense", action="store_true", default=False,
+                        dest="dense", help="store the table as dense arrays "
+                                           "of counts, faster to build and "
+                                           "to use for short prefixes over "
+                                           "small alphabets (needs a prefix "
+                                           "and NumPy; binary files store "
+                                           "the table as a trie)")
+    parser.add_argument("--lower", action="store_true", default=False,
+                        dest="lower", help="lowercase the words of the text")
+    parser.add_argument("--normalize", choices=["NFC", "NFKC", "NFD", "NFKD"],
+                        default=None, dest="normalization",
+                        help="normalize the words of the text with the given "
+                             "Unicode normalization form")
+    parser.add_argument("--filter", action="store_true", default=False,
+                        dest="filter", help="keep a Bloom filter of the "
+                                            "words of the text in the table, "
+                                            "to generate novel words")
+    parser.add_argument("--error-rate", type=float, default=0.01,
+                        dest="error_rate", help="the probability that the "
+                                                "filter finds a word that is "
+                                                "not in the text "
+                                                "(default: 0.01)")
+    parser.add_argument("--min-count", type=natural, default=0,
+                        dest="min_count", help="prune the contexts occurring "
+                                               "less than this number of "
+                                               "times")
+    parser.add_argument("--max-contexts", type=nonzero_natural, default=None,
+                        dest="max_contexts", help="prune the table to at most "
+                                                  "this number of contexts")
+    parser.add_argument("--max-kl", type=float, default=None, dest="max_kl",
+                        help="prune the contexts whose choices diverge from "
+                             "the ones of their suffix by at most this "
+                             "Kullback-Leibler divergence")
+    parser.add_argument("--min-weight", type=natural, default=0,
+                        dest="min_weight", help="prune the successors of "
+                                                "lower weights")
     parser.add_argument("--check", "-c", action="store_true", default=False,
                         dest="check", help="also check that the table is "
                                            "complete")
+    parser.add_argument("--jobs", "-j", type=nonzero_natural, default=1,
+                        dest="jobs", help="the number of processes building "
+                                          "the table (default: 1)")
+    parser.add_argument("--update", "-u", default=None, dest="update",
+                        help="a table file to update with the words of the "
+                             "text; the prefix and flatten of the table are "
+                             "kept")
+    parser.add_argument("--remove", "-r", action="store_true", default=False,
+                        dest="remove", help="remove the words of the text "
+                                            "from the updated table instead "
+                                            "of adding them")
     parser.add_argument("--output", "-o", type=argparse.FileType('wb'),
                         default=None, dest="output",
-                        help="the output destination; "
-                             "if missing, print the table")
-    return parser.parse_args()
+                        help="the output destination; if missing, print the "
+                             "table, or save it to the updated table file")
+    parser.add_argument("--format", choices=["pickle", "binary"],
+                        default=None, dest="format",
+                        help="the format of the output file; binary files "
+                             "are memory-mapped when loaded "
+                             "(default: pickle, or the format of the updated "
+                             "table file)")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        dest="stats", help="print statistics about the "
+                                           "phases of the extraction on "
+                                           "stderr")
+    args = parser.parse_args()
+    if not 0 < args.error_rate < 1:
+        parser.error("the error rate must be between 0 and 1")
+    if args.dense and numpy is None:
+        parser.error("dense tables need NumPy")
+    if args.dense and not args.prefix and not args.update:
+        parser.error("dense tables need a prefix")
+    return args
 
 if __name__ == "__main__":
+    # Use the classes of the package, not the ones of this script
+    from wagoner.table import Table
+    from wagoner.dense import DenseTable
+    from wagoner import storage
+
     args = process_arguments()
+    if args.stats:
+        statistics = stats.Statistics()
+        stats.register(statistics)
 
-    table = Table.from_words(extract_words(args.text), prefix=args.prefix,
-                             flatten=args.flatten)
+    try:
+        if args.update:
+            with stats.phase("load table"):
+                if storage.is_binary(args.update):
+                    mapped = storage.load(args.update)
+                    table = Table(prefix=mapped.prefix,
+                                  flatten=mapped.flatten).merge(mapped)
+                    args.format = args.format or "binary"
+                else:
+                    with open(args.update, "rb") as table_file:
+                        table = pickle.load(table_file)
+                    args.format = args.format or "pickle"
+                if args.dense and not isinstance(table, DenseTable):
+                    table = DenseTable(prefix=table.prefix,
+                                       flatten=table.flatten).merge(table)
+            with stats.phase("update table"):
+                words = Counter(extract_block_words(
+                    text_blocks(args.text), lower=args.lower,
+                    normalization=args.normalization))
+                if args.remove:
+                    table.remove(words)
+                else:
+                    table.update(words)
+            if args.output is None:
+                args.output = open(args.update, "wb")
+        else:
+            with stats.phase("build table"):
+                if args.jobs > 1 and args.text is not sys.stdin:
+                    table = parallel_table(args.text.name, args.jobs,
+                                           prefix=args.prefix,
+                                           flatten=args.flatten,
+                                           encoding=args.text.encoding,
+                                           lower=args.lower,
+                                           normalization=args.normalization)
+                    if args.dense:
+                        table = DenseTable(prefix=args.prefix,
+                                           flatten=args.flatten).merge(table)
+                else:
+                    words = Counter(extract_block_words(
+                        text_blocks(args.text), lower=args.lower,
+                        normalization=args.normalization))
+                    table = (DenseTable if args.dense else Table).from_words(
+                        words, prefix=args.prefix, flatten=args.flatten)
+            if args.filter:
+                with stats.phase("build filter"):
+                    if args.jobs > 1 and args.text is not sys.stdin:
+                        words = set(extract_block_words(
+                            text_blocks(args.text), lower=args.lower,
+                            normalization=args.normalization))
+                    table.corpus = BloomFilter.from_words(words,
+                                                          args.error_rate)
+    except ValueError as error:
+        # Dense tables over too large alphabets, or words to remove that are
+        # not in the table
+        message = str(error)
+        print("[ERROR] %s." % (message[:1].upper() + message[1:]),
+              file=sys.stderr)
+        sys.exit(1)
+    if (args.min_count or args.max_contexts is not None or
+            args.max_kl is not None or args.min_weight):
+        with stats.phase("prune table"):
+            report = table.prune(min_count=args.min_count,
+                                 max_contexts=args.max_contexts,
+                                 max_kl=args.max_kl,
+                                 min_weight=args.min_weight)
+        print("[INFO] Pruned the table from %d to %d contexts and from %d to "
+              "%d successors; the choices moved by %.4f on average and by "
+              "%.4f at most (total variation distance)." %
+              (report["contexts"] + report["successors"] +
+               (report["mean_distance"], report["max_distance"])),
+              file=sys.stderr)
     if args.check and not table.check():
         print("[ERROR] The given text yields an incomplete table.",
               file=sys.stderr)
     else:
-        if args.output:
-            pickle.dump(table, args.output)
-        else:
-            print(table)
+        with stats.phase("save table"):
+            if args.output and args.format == "binary":
+                storage.dump(table, args.output)
+            elif args.output:
+                pickle.dump(table, args.output)
+            else:
+                print(table)
+    if args.stats:
+        print(statistics.report(), file=sys.stderr)
@@ -4,14 +4,64 @@
 The tree module extract, from a table, a tree limited to a given depth.
 """
 
-from __future__ import print_function
+from __future__ import division, print_function
 import argparse
+import array
 import pickle
-from collections import defaultdict, Mapping
+import random
+import sys
+import timeit
+from collections import Counter, defaultdict, Mapping
 from wagoner.utils import *
 from wagoner.table import Table
+from wagoner import stats
 
-__all__ = ["Tree"]
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+try:
+    unichr
+except NameError:  # Python 3
+    unichr = chr
+
+__all__ = ["Tree", "MultiTree", "LazyTree"]
+
+# The approximate costs of building trees, measured with CPython 3 on a
+# 64-bit platform: the bytes of each node and edge of a tree (without its
+# suffixes), the bytes taken by from_table for each expanded node and edge
+# (without the tree), and the seconds spent by from_table on each expanded
+# edge and on each edge of the tree
+NODE_BYTES = 20
+EDGE_BYTES = 28
+EXPANDED_NODE_BYTES = 250
+EXPANDED_EDGE_BYTES = 165
+EXPANDED_EDGE_SECONDS = 2e-6
+EDGE_SECONDS = 2.5e-6
+
+
+def _search(sizes, suffixes, node):
+    """
+    Return the identifier of the given node, or None if it is not a node.
+
+    :param sizes: the sizes of the nodes;
+    :param suffixes: the suffixes of the nodes;
+    :param node: the node (suffix and size) to look for;
+    :return: the index of node in the nodes sorted by size then suffix, or
+             None.
+    """
+    key = (node[1], node[0])
+    low, high = 0, len(sizes)
+    while low < high:
+        middle = (low + high) // 2
+        if (sizes[middle], suffixes[middle]) < key:
+            low = middle + 1
+        else:
+            high = middle
+    if low < len(sizes) and (suffixes[low], sizes[low]) == tuple(node):
+        return low
+    return None
 
 
 class Tree(Mapping):
@@ -19,15 +69,58 @@ class Tree(Mapping):
     A tree is a mapping of nodes to mappings of nodes to weights. Each node is
     a pair of string and length, meaning that if a word of length ends with the
     string, it can be followed by successors, according to the given weights.
+
+    The nodes of a tree are identified by integers, sorted by size then
+    suffix, and their successors are stored in flat arrays (compressed sparse
+    rows): the edges of node n are between offsets[n] and offsets[n + 1], and
+    each edge gives its target node, the character it emits and its weight.
+    The weights of the edges of a node are normalized to sum up to 1, and an
+    alias table is built for each node, such that choosing a successor costs
+    two random numbers and no search.
+
+    Trees extracted from a table keep the Bloom filter of the corpus of the
+    table, if any, in their corpus attribute (None otherwise).
     """
 
     def __init__(self, tree):
         """
         Create a new tree from the given tree content.
 
-        :param tree: the tree content.
+        :param tree: the tree content, that is, a mapping of nodes to
+                     mappings of nodes to weights.
         """
-        self.__content = tree
+        nodes = set(tree)
+        for successors in tree.values():
+            nodes.update(successors)
+        nodes = sorted(nodes, key=lambda node: (node[1], node[0]))
+        identifiers = {node: identifier
+                       for identifier, node in enumerate(nodes)}
+        suffixes = {}
+        self._suffixes = [suffixes.setdefault(suffix, suffix)
+                          for suffix, _ in nodes]
+        self._sizes = array.array("I", (size for _, size in nodes))
+        self._offsets = array.array("L", [0])
+        self._targets = array.array("I")
+        self._characters = array.array("I")
+        self._weights = array.array("d")
+        self._probabilities = array.array("d")
+        self._aliases = array.array("I")
+        self._size = 0
+        self.corpus = None
+        for node in nodes:
+            successors = sorted(tree.get(node, {}).items())
+            if successors:
+                self._size += 1
+                total = sum(weight for _, weight in successors)
+                weights = [weight / total for _, weight in successors]
+                probabilities, aliases = alias_table(weights)
+                for successor, _ in successors:
+                    self._targets.append(identifiers[successor])
+                    self._characters.append(ord(successor[0][-1]))
+                self._weights.extend(weights)
+                self._probabilities.extend(probabilities)
+                self._aliases.extend(aliases)
+            self._offsets.append(len(self._targets))
 
     @classmethod
     def from_table(cls, table, length, prefix=0, flatten=False):
@@ -44,30 +137,188 @@ class Tree(Mapping):
         :param flatten: whether to flatten the table or not;
         :return: the tree corresponding to words of length from table.
         """
-        # Build the expanded tree with necessary suffix and length
-        tree = defaultdict(dict)  # The tree
-        pending = {(">", 0)}  # The nodes to expand
-        while pending:
-            suffix, size = pending.pop()
-            if size < length:
-                choices = table.weighted_choices(suffix, exclude={"<"},
-                                                 flatten=flatten)
-                # The word length is not reached yet, expand
-                for successor, weight in choices.items():
-                    expanded = suffix + successor
-                    if prefix > 0:
-                        expanded = expanded[-prefix:]
-                    new_node = (expanded, size + 1)
-                    tree[(suffix, size)][new_node] = weight
-                    pending.add(new_node)
-            else:
-                choices = table.weighted_choices(suffix, flatten=flatten)
-                # The word length is reached, only add < if present
-                if "<" in choices:
-                    tree[(suffix, size)][("<", size + 1)] = 1
+        # Build the expanded tree level by level, a level being the nodes of
+        # a given size
+        expansions = {}  # The choices of bounded suffixes, without <
+        endings = {}  # Whether bounded suffixes can be followed by <
+        levels = []
+        suffixes = {">"}  # The suffixes of the nodes of the current level
+        for size in range(length + 1):
+            level = {}
+            next_suffixes = set()
+            for suffix in suffixes:
+                successors = {}
+                if size < length:
+                    # The word length is not reached yet, expand
+                    choices = expansions.get(suffix)
+                    if choices is None:
+                        choices = table.weighted_choices(suffix,
+                                                         exclude={"<"},
+                                                         flatten=flatten)
+                        if prefix > 0:
+                            expansions[suffix] = choices
+                    for successor, weight in choices.items():
+                        expanded = suffix + successor
+                        if prefix > 0:
+                            expanded = expanded[-prefix:]
+                        successors[(expanded, size + 1)] = weight
+                        next_suffixes.add(expanded)
+                else:
+                    # The word length is reached, only add < if present
+                    ending = endings.get(suffix)
+                    if ending is None:
+                        ending = "<" in table.weighted_choices(
+                            suffix, flatten=flatten)
+                        if prefix > 0:
+                            endings[suffix] = ending
+                    if ending:
+                        successors[("<", size + 1)] = 1
+                level[(suffix, size)] = successors
+            levels.append(level)
+            suffixes = next_suffixes
+            stats.count("tree.nodes_expanded", len(level))
+
+        # Keep the nodes that can reach the end of words, from the deepest
+        # level up to the root
+        tree = {}
+        live = {("<", length + 1)}
+        while levels:
+            level = levels.pop()
+            live_level = set()
+            for node, successors in level.items():
+                successors = {successor: weight
+                              for successor, weight in successors.items()
+                              if successor in live}
+                if successors:
+                    tree[node] = successors
+                    live_level.add(node)
+            live = live_level
+            stats.count("tree.nodes_pruned", len(level) - len(live_level))
+        result = cls(tree)
+        result.corpus = getattr(table, "corpus", None)
+        return result
+
+    @staticmethod
+    def estimate(table, length, prefix=0):
+        """
+        Estimate the size of the tree extracted by from_table from the given
+        table, for word length and prefix, without building it.
+
+        :param table: the table to extract the tree from;
+        :param length: the length of words generated by the tree; >= 1;
+        :param prefix: if greater than 0, the length of the prefixes used for
+                       computing successors;
+        :return: a dictionary giving the number of nodes and edges expanded
+                 by from_table ("expanded_nodes" and "expanded_edges"), the
+                 number of nodes and edges of the tree ("nodes" and "edges"),
+                 the predicted memory taken by the tree and the peak memory
+                 taken by from_table, in bytes ("memory" and
+                 "peak_memory"), and the predicted time taken by
+                 from_table, in seconds ("seconds").
+
+        The nodes are counted level by level, as states of the generation
+        with their number of nodes. With a prefix, the state of a node is its
+        suffix, and distinct suffixes are distinct nodes. Without prefix, the
+        state of a node is the tuple of its contexts in table (see
+        Table._contexts), which determines its successors, and a state
+        stands for all the words reaching it. The choices are thus computed
+        once per distinct state, and only the states of each level are kept.
+        The live nodes, that can reach the end of a word, are then counted
+        from the last level up to the root.
+
+        The node and edge counts are exact; the memory and time are
+        approximations, based on the costs measured on one platform.
+        """
+        if prefix > 0:
+            start = ">"
+
+            def advance(state, character):
+                return (state + character)[-prefix:]
+
+            def choices(state):
+                return table.weighted_choices(state)
+        else:
+            start = table._contexts(">")
+
+            def advance(state, character):
+                return table._advance(state, character)
+
+            def choices(state):
+                return table._weighted_choices(state)
+
+        transitions = {}  # The successors of each state, and its ending
+        choices_seconds = 0
+        expanded_nodes = expanded_edges = 0
+        levels = []
+        level = {start: 1}
+        for size in range(length + 1):
+            levels.append(level)
+            next_level = defaultdict(int)
+            for state, count in level.items():
+                if state not in transitions:
+                    begin = timeit.default_timer()
+                    weighted = choices(state)
+                    choices_seconds += timeit.default_timer() - begin
+                    transitions[state] = ([(character,
+                                            advance(state, character))
+                                           for character in weighted
+                                           if character != "<"],
+                                          "<" in weighted)
+                successors, ending = transitions[state]
+                expanded_nodes += count
+                if size < length:
+                    expanded_edges += count * len(successors)
+                    for _, target in successors:
+                        if prefix > 0:
+                            next_level[target] = 1
+                        else:
+                            next_level[target] += count
+                elif ending:
+                    expanded_edges += count
+            level = next_level
+            stats.count("tree.states_expanded", len(levels[-1]))
+
+        nodes = edges = strings = 0
+        live = set()
+        suffixes = set()
+        for size in range(length, -1, -1):
+            live_level = set()
+            for state, count in levels[size].items():
+                successors, ending = transitions[state]
+                if size == length:
+                    outgoing = 1 if ending else 0
                 else:
-                    tree[(suffix, size)] = dict()
-        return cls(cls.trim_tree(tree))
+                    outgoing = sum(1 for _, target in successors
+                                   if target in live)
+                if outgoing:
+                    live_level.add(state)
+                    nodes += count
+                    edges += count * outgoing
+                    if prefix > 0:
+                        suffixes.add(state)
+                    else:
+                        strings += count * sys.getsizeof(">" * (size + 1))
+            live = live_level
+        if edges:
+            nodes += 1  # The end node
+        if prefix > 0:
+            strings = sum(sys.getsizeof(suffix) for suffix in suffixes)
+
+        # Without prefix, from_table computes the choices of each node
+        calls = (len(transitions) if prefix > 0 else expanded_nodes)
+        mean_seconds = choices_seconds / max(len(transitions), 1)
+        memory = nodes * NODE_BYTES + edges * EDGE_BYTES + strings
+        return {"expanded_nodes": expanded_nodes,
+                "expanded_edges": expanded_edges,
+                "nodes": nodes,
+                "edges": edges,
+                "memory": memory,
+                "peak_memory": (memory +
+                                expanded_nodes * EXPANDED_NODE_BYTES +
+                                expanded_edges * EXPANDED_EDGE_BYTES),
+                "seconds": (calls * mean_seconds +
+                            expanded_edges * EXPANDED_EDGE_SECONDS +
+                            edges * EDGE_SECONDS)}
 
     @staticmethod
     def trim_tree(tree):
@@ -79,35 +330,73 @@ class Tree(Mapping):
 
         :param tree: the tree;
         :return: the tree without dead branches.
+
+        The live nodes, that is, the nodes that can reach a node ending with
+        the < character, are found by a single backward traversal of the
+        edges of tree.
         """
-        # Remove empty nodes
-        new_tree = {k: v for k, v in tree.items() if v}
-        # Remove missing successors
-        new_tree = {k: {successor: weight for successor, weight in v.items()
-                        if successor in new_tree or successor[0] == "<"}
-                    for k, v in new_tree.items()}
-        while tree != new_tree:
-            tree = new_tree
-            # Remove empty nodes
-            new_tree = {k: v for k, v in tree.items() if v}
-            # Remove missing successors
-            new_tree = {k: {successor: weight
-                            for successor, weight in v.items()
-                            if successor in new_tree or successor[0] == "<"}
-                        for k, v in new_tree.items()}
-        return new_tree
+        predecessors = defaultdict(list)
+        pending = []
+        for node, successors in tree.items():
+            for successor in successors:
+                predecessors[successor].append(node)
+                if successor[0] == "<":
+                    pending.append(node)
+        live = set(pending)
+        while pending:
+            node = pending.pop()
+            for predecessor in predecessors[node]:
+                if predecessor not in live:
+                    live.add(predecessor)
+                    pending.append(predecessor)
+        stats.count("tree.nodes_pruned", len(tree) - len(live))
+        return {node: {successor: weight
+                       for successor, weight in tree[node].items()
+                       if successor in live or successor[0] == "<"}
+                for node in live}
+
+    def _node(self, identifier):
+        """
+        Return the node (suffix and size) with the given identifier.
+        """
+        return self._suffixes[identifier], self._sizes[identifier]
+
+    def _identifier(self, node):
+        """
+        Return the identifier of the given node, or None if it is not a node
+        of this tree.
+        """
+        return _search(self._sizes, self._suffixes, node)
 
     def __getitem__(self, key):
-        return self.__content[key]
+        identifier = self._identifier(key)
+        if identifier is None:
+            raise KeyError(key)
+        start = self._offsets[identifier]
+        end = self._offsets[identifier + 1]
+        if start == end:
+            raise KeyError(key)
+        return {self._node(self._targets[edge]): self._weights[edge]
+                for edge in range(start, end)}
 
     def __iter__(self):
-        return iter(self.__content)
+        for identifier in range(len(self._sizes)):
+            if self._offsets[identifier] < self._offsets[identifier + 1]:
+                yield self._node(identifier)
 
     def __len__(self):
-        return len(self.__content)
+        return self._size
 
     def __str__(self):
-        return str(self.__content)
+        return str(dict(self.items()))
+
+    def __setstate__(self, state):
+        if "_Tree__content" in state:
+            # Tree pickled before the compressed sparse rows
+            self.__init__(state["_Tree__content"])
+        else:
+            state.setdefault("corpus", None)
+            self.__dict__.update(state)
 
     def random_word(self, *args, **kwargs):
         """
@@ -115,17 +404,698 @@ class Tree(Mapping):
         the this tree.
 
         :return: a random word from this tree.
+        :raises GenerationError: if this tree generates no word.
+
+        args and kwargs are ignored.
+        """
+        offsets = self._offsets
+        word = []
+        current = self._identifier((">", 0))
+        if current is None or offsets[current] == offsets[current + 1]:
+            raise GenerationError("the tree generates no word")
+        while offsets[current] < offsets[current + 1]:
+            start = offsets[current]
+            edge = start + int(random.random() *
+                               (offsets[current + 1] - start))
+            if random.random() >= self._probabilities[edge]:
+                edge = start + self._aliases[edge]
+            word.append(self._characters[edge])
+            current = self._targets[edge]
+        return "".join(unichr(character) for character in word[:-1])
+
+    def random_words(self, count, *args, **kwargs):
+        """
+        Return count random words from this tree. The length of the words
+        depends on this tree.
+
+        :param count: the number of words to generate;
+        :return: a list of count random words from this tree.
+        :raises GenerationError: if this tree generates no word.
+
+        If NumPy is available, the words are generated together, one
+        character at a time, by drawing the random numbers for all words at
+        once and choosing the successors of all nodes with their alias tables
+        in a few array operations. Otherwise, the words are generated one by
+        one with random_word.
+
+        args and kwargs are ignored.
+        """
+        if numpy is None:
+            return [self.random_word() for _ in range(count)]
+        root = self._identifier((">", 0))
+        if root is None or self._offsets[root] == self._offsets[root + 1]:
+            raise GenerationError("the tree generates no word")
+        if count == 0:
+            return []
+        offsets = numpy.asarray(memoryview(self._offsets))
+        targets = numpy.asarray(memoryview(self._targets))
+        characters = numpy.asarray(memoryview(self._characters))
+        probabilities = numpy.asarray(memoryview(self._probabilities))
+        aliases = numpy.asarray(memoryview(self._aliases))
+        current = numpy.full(count, root, dtype=numpy.int64)
+        columns = []
+        while True:
+            start = offsets[current].astype(numpy.int64)
+            degree = offsets[current + 1].astype(numpy.int64) - start
+            if not degree.any():
+                break
+            edges = start + (numpy.random.random(count) *
+                             degree).astype(numpy.int64)
+            aliased = numpy.random.random(count) >= probabilities[edges]
+            edges[aliased] = start[aliased] + aliases[edges[aliased]]
+            columns.append(characters[edges])
+            current = targets[edges]
+        words = numpy.stack(columns[:-1], axis=1).astype(numpy.uint32)
+        return words.view("U%d" % (len(columns) - 1)).ravel().tolist()
+
+    def _completions(self):
+        """
+        Return the number of words that can be completed from each node of
+        this tree, that is, the number of paths from the node to the end of a
+        word. The numbers are computed once, from the deepest nodes up to the
+        root, and kept.
+
+        :return: the list of the numbers of completions of the nodes.
+        """
+        completions = self.__dict__.get("_completion_counts")
+        if completions is None:
+            offsets, targets = self._offsets, self._targets
+            completions = [0] * len(self._sizes)
+            # Edges go from a size to the next, so nodes are processed
+            # after their successors
+            for identifier in range(len(self._sizes) - 1, -1, -1):
+                start, end = offsets[identifier], offsets[identifier + 1]
+                if start == end:
+                    completions[identifier] = int(
+                        self._suffixes[identifier] == "<")
+                else:
+                    completions[identifier] = sum(completions[targets[edge]]
+                                                  for edge in range(start,
+                                                                    end))
+            self._completion_counts = completions
+        return completions
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_completion_counts", None)
+        return state
+
+    def word_count(self):
+        """
+        Return the number of distinct words this tree can generate.
+
+        :return: the number of words of this tree.
+        """
+        root = self._identifier((">", 0))
+        return self._completions()[root] if root is not None else 0
+
+    def rank(self, word):
+        """
+        Return the rank of word among the words of this tree, the words being
+        sorted by the order of the edges of the nodes (that is, by
+        characters).
+
+        :param word: a word of this tree;
+        :return: the rank of word, between 0 and word_count() - 1.
+        :raises ValueError: if word is not a word of this tree.
+        """
+        completions = self._completions()
+        current = self._identifier((">", 0))
+        rank = 0
+        for character in word + "<":
+            if current is None:
+                break
+            code = ord(character)
+            following = None
+            for edge in range(self._offsets[current],
+                              self._offsets[current + 1]):
+                if self._characters[edge] == code:
+                    following = self._targets[edge]
+                    break
+                rank += completions[self._targets[edge]]
+            current = following
+        else:
+            if current is not None:
+                return rank
+        raise ValueError("%s is not a word of the tree" % word)
+
+    def unrank(self, rank):
+        """
+        Return the word of the given rank among the words of this tree.
+
+        :param rank: the rank of the word, between 0 and word_count() - 1;
+        :return: the word of rank.
+        :raises IndexError: if rank is out of range.
+        """
+        completions = self._completions()
+        current = self._identifier((">", 0))
+        if rank < 0 or rank >= self.word_count():
+            raise IndexError("word rank out of range")
+        word = []
+        while self._offsets[current] < self._offsets[current + 1]:
+            for edge in range(self._offsets[current],
+                              self._offsets[current + 1]):
+                target = self._targets[edge]
+                if rank < completions[target]:
+                    break
+                rank -= completions[target]
+            word.append(self._characters[edge])
+            current = target
+        return "".join(unichr(character) for character in word[:-1])
+
+    def sample_distinct(self, count, weighted=False):
+        """
+        Return count distinct random words from this tree.
+
+        :param count: the number of words; at most word_count();
+        :param weighted: whether the words are drawn with the probabilities of
+                         random_word (without replacement), or uniformly;
+        :return: a list of count distinct words of this tree.
+        :raises ValueError: if this tree has less than count words.
+
+        Uniform words are drawn as distinct ranks with Floyd's algorithm, then
+        unranked. Weighted words are drawn one after the other, each word
+        being drawn among the remaining ones: the drawn words are kept in a
+        trie recording, for each drawn prefix, the probability of its drawn
+        completions, and the choices of the edges are weighted by the
+        probability of their remaining completions.
+        """
+        total = self.word_count()
+        if count > total:
+            raise ValueError("the tree has only %d words" % total)
+        if not weighted:
+            return [self.unrank(rank) for rank in random_sample(total, count)]
+
+        completions = self._completions()
+        offsets, targets = self._offsets, self._targets
+        root = self._identifier((">", 0))
+        # The trie of drawn words; each edge of a drawn prefix is mapped to
+        # the probability of the drawn completions of its target, the number
+        # of these completions and the edges of the target
+        drawn = {}
+        words = []
+        for _ in range(count):
+            current = root
+            edges = drawn
+            path = []
+            while offsets[current] < offsets[current + 1]:
+                choices = {}
+                for edge in range(offsets[current], offsets[current + 1]):
+                    entry = edges.get(edge)
+                    if entry is None:
+                        choices[edge] = self._weights[edge]
+                    elif entry[1] < completions[targets[edge]]:
+                        choices[edge] = (self._weights[edge] *
+                                         max(1 - entry[0], 0))
+                if not any(choices.values()):
+                    # The remaining probabilities are lost in rounding
+                    choices = dict.fromkeys(choices, 1)
+                edge = random_weighted_choice(choices)
+                entry = edges.setdefault(edge, [0, 0, {}])
+                path.append((edge, entry))
+                edges = entry[2]
+                current = targets[edge]
+            for edge, entry in reversed(path):
+                entry[1] += 1
+                entry[0] = (sum(self._weights[child] * child_entry[0]
+                                for child, child_entry in entry[2].items())
+                            if entry[2] else 1)
+            words.append("".join(unichr(self._characters[edge])
+                                 for edge, _ in path[:-1]))
+        return words
+
+
+class MultiTree(object):
+    """
+    A multi-tree merges the trees extracted from a table for a range of word
+    lengths. Its nodes are the nodes of these trees, that is, pairs of suffix
+    and size, and its edges are their edges, except the edges ending the
+    words. Each node has a mask of the lengths of the words that can end
+    after it instead: bit l of the mask is set if a word of length l can end
+    after the node.
+
+    A word of length l is generated by following, from the root, the edges to
+    the nodes whose mask has bit l set, until a node of size l is reached;
+    the words are thus generated with the same probabilities as with the tree
+    of length l. The edges of the nodes are stored in compressed sparse rows,
+    like the ones of trees, and the samplers of the viable edges of the nodes
+    for a given length are built when needed and kept in a cache of
+    sampler_cache_size items. Like trees, multi-trees keep the corpus filter
+    of their table in their corpus attribute.
+    """
+
+    sampler_cache_size = 100000
+
+    def __init__(self, tree, masks, lengths):
+        """
+        Create a new multi-tree from the given content.
+
+        :param tree: the edges of the multi-tree, that is, a mapping of nodes
+                     to mappings of nodes to weights;
+        :param masks: the mapping of the nodes of the multi-tree to their
+                      masks of lengths;
+        :param lengths: the lengths of the words of the multi-tree.
+        """
+        self.lengths = tuple(sorted(set(lengths)))
+        self.corpus = None
+        nodes = sorted(masks, key=lambda node: (node[1], node[0]))
+        identifiers = {node: identifier
+                       for identifier, node in enumerate(nodes)}
+        suffixes = {}
+        self._suffixes = [suffixes.setdefault(suffix, suffix)
+                          for suffix, _ in nodes]
+        self._sizes = array.array("I", (size for _, size in nodes))
+        self._masks = [masks[node] for node in nodes]
+        self._offsets = array.array("L", [0])
+        self._targets = array.array("I")
+        self._characters = array.array("I")
+        self._weights = array.array("d")
+        for node in nodes:
+            successors = sorted(tree.get(node, {}).items())
+            total = sum(weight for _, weight in successors)
+            for successor, weight in successors:
+                self._targets.append(identifiers[successor])
+                self._characters.append(ord(successor[0][-1]))
+                self._weights.append(weight / total)
+            self._offsets.append(len(self._targets))
+        self._reset_caches()
+
+    @classmethod
+    def from_table(cls, table, lengths, prefix=0, flatten=False):
+        """
+        Extract from the given table a multi-tree for the given word lengths,
+        taking only prefixes of prefix length (if greater than 0) into account
+        to compute successors.
+
+        :param table: the table to extract the multi-tree from;
+        :param lengths: the lengths of words generated by the extracted
+                        multi-tree; greater or equal to 1;
+        :param prefix: if greater than 0, the length of the prefixes used for
+                       computing successors;
+        :param flatten: whether to flatten the table or not;
+        :return: the multi-tree corresponding to words of lengths from table.
+
+        The multi-tree is built like the tree of the largest length, except
+        that the nodes of the sizes of lengths can also end the words; the
+        choices of each bounded suffix are thus computed once for all lengths.
+        """
+        lengths = set(lengths)
+        expansions = {}  # The choices of bounded suffixes, without <
+        endings = {}  # Whether bounded suffixes can be followed by <
+        levels = []
+        suffixes = {">"}  # The suffixes of the nodes of the current level
+        for size in range(max(lengths) + 1):
+            level = {}
+            next_suffixes = set()
+            for suffix in suffixes:
+                successors = {}
+                if size < max(lengths):
+                    choices = expansions.get(suffix)
+                    if choices is None:
+                        choices = table.weighted_choices(suffix,
+                                                         exclude={"<"},
+                                                         flatten=flatten)
+                        if prefix > 0:
+                            expansions[suffix] = choices
+                    for successor, weight in choices.items():
+                        expanded = suffix + successor
+                        if prefix > 0:
+                            expanded = expanded[-prefix:]
+                        successors[(expanded, size + 1)] = weight
+                        next_suffixes.add(expanded)
+                ending = False
+                if size in lengths:
+                    ending = endings.get(suffix)
+                    if ending is None:
+                        ending = "<" in table.weighted_choices(
+                            suffix, flatten=flatten)
+                        if prefix > 0:
+                            endings[suffix] = ending
+                level[(suffix, size)] = (successors, ending)
+            levels.append(level)
+            suffixes = next_suffixes
+            stats.count("tree.nodes_expanded", len(level))
+
+        # Compute the masks of the nodes, from the deepest level up to the
+        # root, and keep the nodes that can reach the end of words
+        tree = {}
+        masks = {}
+        while levels:
+            level = levels.pop()
+            live = 0
+            for node, (successors, ending) in level.items():
+                mask = (1 << node[1]) if ending else 0
+                viable = {}
+                for successor, weight in successors.items():
+                    if successor in masks:
+                        viable[successor] = weight
+                        mask |= masks[successor]
+                if mask:
+                    tree[node] = viable
+                    masks[node] = mask
+                    live += 1
+            stats.count("tree.nodes_pruned", len(level) - live)
+        result = cls(tree, masks, lengths)
+        result.corpus = getattr(table, "corpus", None)
+        return result
+
+    def _reset_caches(self):
+        """
+        Empty the caches of samplers of this multi-tree.
+        """
+        self._samplers = LRUCache(self.sampler_cache_size)
+        self._batches = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_samplers"]
+        del state["_batches"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_caches()
+
+    def _node(self, identifier):
+        """
+        Return the node (suffix and size) with the given identifier.
+        """
+        return self._suffixes[identifier], self._sizes[identifier]
+
+    def _identifier(self, node):
+        """
+        Return the identifier of the given node, or None if it is not a node
+        of this multi-tree.
+        """
+        return _search(self._sizes, self._suffixes, node)
+
+    def __str__(self):
+        return str({self._node(identifier):
+                    {self._node(self._targets[edge]): self._weights[edge]
+                     for edge in range(self._offsets[identifier],
+                                       self._offsets[identifier + 1])}
+                    for identifier in range(len(self._sizes))})
+
+    def _viable(self, edge, length):
+        """
+        Return whether the target of the given edge can lead to a word of
+        length.
+        """
+        return self._masks[self._targets[edge]] >> length & 1
+
+    def _root(self, length):
+        """
+        Return the identifier of the root and the length of the word to
+        generate from it.
+
+        :param length: the length of the word, or None for a random length;
+        :return: a (root, length) pair.
+        :raises GenerationError: if no word of length can be generated.
+        """
+        root = self._identifier((">", 0))
+        mask = self._masks[root] if root is not None else 0
+        if length is None:
+            lengths = [length for length in self.lengths
+                       if mask >> length & 1]
+            if not lengths:
+                raise GenerationError("the tree generates no word")
+            length = random.choice(lengths)
+        elif not mask >> length & 1:
+            raise GenerationError("the tree generates no word of length %d" %
+                                  length)
+        return root, length
+
+    def tree(self, length):
+        """
+        Return the tree of the words of the given length of this multi-tree.
+
+        :param length: the length of the words of the tree;
+        :return: the tree generating the words of length of this multi-tree.
+        """
+        content = {}
+        for identifier in range(len(self._sizes)):
+            size = self._sizes[identifier]
+            if size > length or not self._masks[identifier] >> length & 1:
+                continue
+            if size == length:
+                successors = {("<", length + 1): 1}
+            else:
+                successors = {self._node(self._targets[edge]):
+                              self._weights[edge]
+                              for edge in range(self._offsets[identifier],
+                                                self._offsets[identifier + 1])
+                              if self._viable(edge, length)}
+            content[self._node(identifier)] = successors
+        return Tree(content)
+
+    def _sampler(self, identifier, length):
+        """
+        Return the sampler of the edges of the given node that lead to words
+        of length.
+
+        :param identifier: the identifier of a node of size smaller than
+                           length, that can lead to words of length;
+        :param length: the length of the words;
+        :return: a sampler of the edges of the node.
+        """
+        key = (identifier, length)
+        sampler = self._samplers.get(key)
+        if sampler is None:
+            sampler = Sampler({edge: self._weights[edge]
+                               for edge in range(self._offsets[identifier],
+                                                 self._offsets[identifier + 1])
+                               if self._viable(edge, length)})
+            self._samplers[key] = sampler
+        return sampler
+
+    def random_word(self, length=None, *args, **kwargs):
+        """
+        Return a random word of the given length from this multi-tree.
+
+        :param length: the length of the word; if None, the length is chosen
+                       at random among the lengths of this multi-tree;
+        :return: a random word from this multi-tree.
+        :raises GenerationError: if this multi-tree generates no word of
+                                 length.
+
+        args and kwargs are ignored.
+        """
+        current, length = self._root(length)
+        word = []
+        while self._sizes[current] < length:
+            edge = self._sampler(current, length).choice()
+            word.append(self._characters[edge])
+            current = self._targets[edge]
+        return "".join(unichr(character) for character in word)
+
+    def _batch(self, length):
+        """
+        Return the batch sampler of the edges leading to words of length, the
+        states of the sampler being the identifiers of the nodes.
+        """
+        sampler = self._batches.get(length)
+        if sampler is None:
+            sampler = BatchSampler()
+            for identifier in range(len(self._sizes)):
+                sampler.add([(edge, self._weights[edge])
+                             for edge in range(self._offsets[identifier],
+                                               self._offsets[identifier + 1])
+                             if self._viable(edge, length)])
+            self._batches[length] = sampler
+        return sampler
+
+    def random_words(self, count, length=None, *args, **kwargs):
+        """
+        Return count random words of the given length from this multi-tree.
+
+        :param count: the number of words to generate;
+        :param length: the length of the words; if None, the length of each
+                       word is chosen at random among the lengths of this
+                       multi-tree;
+        :return: a list of count random words from this multi-tree.
+        :raises GenerationError: if this multi-tree generates no word of
+                                 length.
+
+        If NumPy is available, the words of each length are generated
+        together, with a batch sampler of the edges leading to words of this
+        length; otherwise, the words are generated one by one with
+        random_word.
+
+        args and kwargs are ignored.
+        """
+        if numpy is None:
+            return [self.random_word(length) for _ in range(count)]
+        indices = defaultdict(list)  # The indices of the words of each length
+        for index in range(count):
+            root, word_length = self._root(length)
+            indices[word_length].append(index)
+        words = [None] * count
+        for word_length, word_indices in indices.items():
+            sampler = self._batch(word_length)
+            targets = numpy.asarray(memoryview(self._targets))
+            characters = numpy.asarray(memoryview(self._characters))
+            current = numpy.full(len(word_indices), root, dtype=numpy.int64)
+            columns = []
+            for _ in range(word_length):
+                edges = sampler.choose(current)
+                columns.append(characters[edges])
+                current = targets[edges]
+            generated = numpy.stack(columns, axis=1).astype(numpy.uint32)
+            generated = generated.view("U%d" % word_length).ravel().tolist()
+            for index, word in zip(word_indices, generated):
+                words[index] = word
+        return words
+
+
+class LazyTree(object):
+    """
+    A lazy tree generates the same words as the tree extracted from a table,
+    but without building it: the nodes of the tree are expanded when the
+    generation visits them, and whether a node can still reach the end of a
+    word of the tree length (its viability) is computed on demand.
+
+    The successors and the viability of the visited nodes are memoized in
+    caches of at most max_nodes items each; when a cache is full, the least
+    recently used nodes are evicted (and computed again if needed).
+    """
+
+    def __init__(self, table, length, prefix=0, flatten=False,
+                 max_nodes=1000000):
+        """
+        Create a new lazy tree of the given table, for word length.
+
+        :param table: the table to extract the tree from;
+        :param length: the length of words generated by the tree;
+                       greater or equal to 1;
+        :param prefix: if greater than 0, the length of the prefixes used for
+                       computing successors;
+        :param flatten: whether to flatten the table or not;
+        :param max_nodes: the maximum number of nodes kept in each cache.
+        """
+        self.table = table
+        self.length = length
+        self.prefix = prefix
+        self.flatten = flatten
+        self.corpus = getattr(table, "corpus", None)
+        self._choices = LRUCache(max_nodes)
+        self._viable = LRUCache(max_nodes)
+        self._samplers = LRUCache(max_nodes)
+
+    def _successors(self, node):
+        """
+        Return the successors of the given node (whether viable or not), with
+        their weights.
+
+        :param node: a node (suffix and size) of size smaller than the tree
+                     length;
+        :return: a list of (character, successor, weight) triples.
+        """
+        suffix, size = node
+        choices = self._choices.get(suffix)
+        if choices is None:
+            stats.count("lazy_tree.nodes_expanded")
+            choices = []
+            for character, weight in self.table.weighted_choices(
+                    suffix, exclude={"<"}, flatten=self.flatten).items():
+                expanded = suffix + character
+                if self.prefix > 0:
+                    expanded = expanded[-self.prefix:]
+                choices.append((character, expanded, weight))
+            if self.prefix > 0:
+                self._choices[suffix] = choices
+        return [(character, (expanded, size + 1), weight)
+                for character, expanded, weight in choices]
+
+    def viable(self, node):
+        """
+        Return whether the given node can reach the end of a word of the tree
+        length.
+
+        :param node: a node (suffix and size);
+        :return: True if a word of the tree length can end after node.
+        """
+        result = None  # The viability of the last left node
+        stack = [[node, None]]  # The visited nodes with their successors
+        while stack:
+            frame = stack[-1]
+            current, successors = frame
+            if successors is None:
+                # First visit of current
+                known = self._viable.get(current)
+                if known is None:
+                    stats.count("lazy_tree.viability_computed")
+                if known is None and current[1] >= self.length:
+                    known = (current[1] == self.length and
+                             "<" in self.table.weighted_choices(
+                                 current[0], flatten=self.flatten))
+                    self._viable[current] = known
+                if known is not None:
+                    result = known
+                    stack.pop()
+                    continue
+                frame[1] = successors = iter(self._successors(current))
+            elif result:
+                # A successor of current is viable
+                self._viable[current] = True
+                stack.pop()
+                continue
+            for _, successor, _ in successors:
+                stack.append([successor, None])
+                break
+            else:
+                # No successor of current is viable
+                self._viable[current] = False
+                result = False
+                stack.pop()
+        return result
+
+    def _sampler(self, node):
+        """
+        Return the sampler of the viable successors of the given node.
+
+        :param node: a viable node of size smaller than the tree length;
+        :return: a sampler of the (character, successor) pairs of node.
+        """
+        sampler = self._samplers.get(node)
+        if sampler is None:
+            sampler = Sampler({(character, successor): weight
+                               for character, successor, weight
+                               in self._successors(node)
+                               if self.viable(successor)})
+            self._samplers[node] = sampler
+        return sampler
+
+    def random_word(self, *args, **kwargs):
+        """
+        Return a random word from this tree. The length of the word is the
+        length of this tree.
+
+        :return: a random word from this tree.
+        :raises GenerationError: if this tree generates no word.
 
         args and kwargs are ignored.
         """
-        word = ""
         current = (">", 0)
-        while current[0] != "<":
-            choices = self[current]
-            choice = random_weighted_choice(choices)
-            current = choice
-            word += current[0][-1]
-        return word[:-1]
+        if not self.viable(current):
+            raise GenerationError("the tree generates no word")
+        word = ""
+        while current[1] < self.length:
+            character, current = self._sampler(current).choice()
+            word += character
+        return word
+
+    def random_words(self, count, *args, **kwargs):
+        """
+        Return count random words from this tree. The length of the words is
+        the length of this tree.
+
+        :param count: the number of words to generate;
+        :return: a list of count random words from this tree.
+        :raises GenerationError: if this tree generates no word.
+
+        args and kwargs are ignored.
+        """
+        return [self.random_word() for _ in range(count)]
 
 
 def process_arguments():
@@ -133,9 +1103,19 @@ def process_arguments():
     Process the command line arguments. The arguments are:
      * the table to generate random from;
      * -l (or --length) for the length of generated words (default: 10);
+     * -m (or --max-length) for the maximum length of generated words, if the
+       tree generates words of several lengths;
      * -p (or --prefix) for the maximum of prefixes to consider (default: 0);
      * -c (or --count) for the number of words to generate (default: 10);
-     * -f (or --flatten) if the table must be flattened before generation.
+     * -f (or --flatten) if the table must be flattened before generation;
+     * -o (or --output) the output file (default: stdout);
+     * --format the format of the output file (default: pickle);
+     * --estimate if the size of the tree must be estimated instead of
+       building the tree;
+     * --memory for the memory, in megabytes, of the nodes kept in memory
+       while building the tree, the other ones being kept in temporary files
+       (only in binary format);
+     * --stats if statistics must be printed (on stderr).
     """
     parser = argparse.ArgumentParser(description="Generate trees from "
                                                  "the given content",
@@ -149,6 +1129,11 @@ def process_arguments():
     parser.add_argument("--length", "-l", type=nonzero_natural, default=10,
                         dest="length", help="the length of words generable by "
                                             "the tree (default: 10)")
+    parser.add_argument("--max-length", "-m", type=nonzero_natural,
+                        default=None, dest="max_length",
+                        help="if given, build a single tree generating the "
+                             "words of all lengths from --length to this "
+                             "length (only in pickle format)")
     parser.add_argument("--prefix", "-p", type=natural, default=0,
                         dest="prefix", help="if not 0, the maximum length of "
                                             "prefixes to consider when "
@@ -160,20 +1145,108 @@ def process_arguments():
                         default=None, dest="output",
                         help="the output destination; "
                              "if missing, print the tree")
+    parser.add_argument("--format", choices=["pickle", "binary"],
+                        default="pickle", dest="format",
+                        help="the format of the output file; binary files "
+                             "are memory-mapped when loaded "
+                             "(default: pickle)")
+    parser.add_argument("--estimate", action="store_true", default=False,
+                        dest="estimate", help="print the estimated size, "
+                                              "memory and build time of "
+                                              "the tree instead of "
+                                              "building it")
+    parser.add_argument("--memory", type=nonzero_natural, default=None,
+                        dest="memory", help="if given, build the tree with "
+                                            "about this number of megabytes "
+                                            "of nodes in memory, keeping the "
+                                            "other ones in temporary files "
+                                            "(only in binary format)")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        dest="stats", help="print statistics about the "
+                                           "phases of the extraction on "
+                                           "stderr")
     return parser.parse_args()
 
 if __name__ == "__main__":
+    # Use the classes of the package, not the ones of this script
+    from wagoner.tree import Tree, MultiTree
+    from wagoner import storage
+
     args = process_arguments()
-    try:
-        with open(args.content, "rb") as table_file:
-            table = pickle.load(table_file)
-    except pickle.UnpicklingError:
-        with open(args.content, "r") as text_file:
-            table = Table.from_words(extract_words(text_file),
-                                     prefix=args.prefix, flatten=args.flatten)
-    tree = Tree.from_table(table, args.length, prefix=args.prefix,
-                           flatten=args.flatten)
-    if args.output:
-        pickle.dump(tree, args.output)
-    else:
-        print(tree)
+    if args.stats:
+        statistics = stats.Statistics()
+        stats.register(statistics)
+
+    with stats.phase("load table"):
+        if storage.is_binary(args.content):
+            table = storage.load(args.content)
+        else:
+            try:
+                with open(args.content, "rb") as table_file:
+                    table = pickle.load(table_file)
+            except pickle.UnpicklingError:
+                with open(args.content, "r") as text_file:
+                    words = Counter(extract_block_words(
+                        text_blocks(text_file)))
+                    table = Table.from_words(words, prefix=args.prefix,
+                                             flatten=args.flatten)
+    if args.max_length is not None and args.max_length < args.length:
+        print("[ERROR] The maximum length is smaller than the length.",
+              file=sys.stderr)
+        sys.exit(1)
+    if args.max_length is not None and args.format == "binary":
+        print("[ERROR] Multi-length trees cannot be saved in binary format.",
+              file=sys.stderr)
+        sys.exit(1)
+    if args.estimate:
+        with stats.phase("estimate tree"):
+            for length in range(args.length,
+                                (args.max_length or args.length) + 1):
+                estimate = Tree.estimate(table, length, prefix=args.prefix)
+                print("Length %d: %d nodes and %d edges (%d nodes and %d "
+                      "edges expanded), about %.1f MB (%.1f MB while "
+                      "building) and %.1f seconds to build." %
+                      (length, estimate["nodes"], estimate["edges"],
+                       estimate["expanded_nodes"],
+                       estimate["expanded_edges"],
+                       estimate["memory"] / 2 ** 20,
+                       estimate["peak_memory"] / 2 ** 20,
+                       estimate["seconds"]))
+        if args.stats:
+            print(statistics.report(), file=sys.stderr)
+        sys.exit(0)
+    if args.memory is not None:
+        if args.format != "binary" or args.output is None:
+            print("[ERROR] Trees built with bounded memory must be saved in "
+                  "a binary file.", file=sys.stderr)
+            sys.exit(1)
+        if args.max_length is not None:
+            print("[ERROR] Multi-length trees cannot be built with bounded "
+                  "memory.", file=sys.stderr)
+            sys.exit(1)
+        with stats.phase("build tree"):
+            storage.build_tree(table, args.length, args.output,
+                               prefix=args.prefix, flatten=args.flatten,
+                               memory=args.memory * 2 ** 20)
+        if args.stats:
+            print(statistics.report(), file=sys.stderr)
+        sys.exit(0)
+    with stats.phase("build tree"):
+        if args.max_length is not None:
+            tree = MultiTree.from_table(table,
+                                        range(args.length,
+                                              args.max_length + 1),
+                                        prefix=args.prefix,
+                                        flatten=args.flatten)
+        else:
+            tree = Tree.from_table(table, args.length, prefix=args.prefix,
+                                   flatten=args.flatten)
+    with stats.phase("save tree"):
+        if args.output and args.format == "binary":
+            storage.dump(tree, args.output)
+        elif args.output:
+            pickle.dump(tree, args.output)
+        else:
+            print(tree)
+    if args.stats:
+        print(statistics.report(), file=sys.stderr)
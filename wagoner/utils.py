@@ -2,13 +2,36 @@
 A set of utility functions.
 """
 
+from __future__ import division
 import bisect
+import codecs
+from collections import OrderedDict
+import hashlib
+import math
 import operator
+import os
 import random  # TODO Use cryptographic-friendly randomization
 import re
+import struct
+import unicodedata
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
 
 __all__ = ["accumulate", "natural", "nonzero_natural",
-           "random_weighted_choice", "extract_words", "GenerationError"]
+           "random_weighted_choice", "Sampler", "BatchSampler", "alias_table",
+           "random_sample",
+           "LRUCache", "BloomFilter",
+           "extract_words", "extract_block_words", "text_blocks",
+           "file_chunks", "read_lines", "read_blocks", "GenerationError"]
+
+# The pattern of the words of a text
+WORD = re.compile(r"\w+")
+
+# The size, in characters or bytes, of the blocks read from texts
+BLOCK_SIZE = 1 << 20
 
 
 def accumulate(iterable, func=operator.add):
@@ -63,9 +86,12 @@ def random_weighted_choice(choices):
     """
     Return a random key of choices, weighted by their value.
 
-    :param choices: a dictionary of keys and positive integer pairs;
+    :param choices: a dictionary of keys and positive integer pairs, or a
+                    sampler of such a dictionary;
     :return: a random key of choices.
     """
+    if isinstance(choices, Sampler):
+        return choices.choice()
     choices, weights = zip(*choices.items())
     cumdist = list(accumulate(weights))
     x = random.random() * cumdist[-1]
@@ -73,6 +99,334 @@ def random_weighted_choice(choices):
     return choices[element]
 
 
+class Sampler(object):
+    """
+    A sampler draws random keys of a dictionary of weighted choices. The
+    cumulative distribution of the weights is computed once, when the sampler
+    is created, so drawing a key only costs a binary search.
+    """
+
+    __slots__ = ("choices", "cumdist")
+
+    def __init__(self, choices):
+        """
+        Create a new sampler of choices.
+
+        :param choices: a dictionary of keys and positive integer pairs.
+        """
+        if choices:
+            choices, weights = zip(*choices.items())
+            self.choices = choices
+            self.cumdist = list(accumulate(weights))
+        else:
+            self.choices = ()
+            self.cumdist = []
+
+    def choice(self):
+        """
+        Return a random key of the choices of this sampler, weighted by their
+        value.
+
+        :return: a random key of the choices.
+        """
+        x = random.random() * self.cumdist[-1]
+        return self.choices[bisect.bisect(self.cumdist, x)]
+
+    def __len__(self):
+        return len(self.choices)
+
+
+class BatchSampler(object):
+    """
+    A batch sampler draws, at once, random values for many states, each state
+    having its own weighted values. The weights of all states are stored as a
+    single sorted NumPy array of keys, the keys of state s being s plus the
+    normalized cumulative distribution of its weights, such that a choice is
+    drawn for each state with a single binary search over the keys.
+
+    Batch samplers need NumPy.
+    """
+
+    def __init__(self):
+        """
+        Create a new batch sampler, without any state.
+        """
+        self._keys = []
+        self._values = []
+        self._ends = [0]
+        self._arrays = None
+
+    def add(self, choices):
+        """
+        Add a new state with the given weighted values.
+
+        :param choices: a list of (value, weight) pairs, where values are
+                        integers and weights are positive numbers;
+        :return: the identifier of the new state.
+        """
+        state = len(self._ends) - 1
+        if choices:
+            values, weights = zip(*choices)
+            total = sum(weights)
+            cumdist = numpy.cumsum([weight / total for weight in weights])
+            cumdist[-1] = 1
+            self._keys.append(state + cumdist)
+            self._values.append(numpy.array(values, dtype=numpy.int64))
+        self._ends.append(self._ends[-1] + len(choices))
+        self._arrays = None
+        return state
+
+    def __len__(self):
+        return len(self._ends) - 1
+
+    def _concatenate(self):
+        """
+        Return the keys, values and ends of the states of this sampler, as
+        NumPy arrays.
+        """
+        if self._arrays is None:
+            if self._keys:
+                self._keys = [numpy.concatenate(self._keys)]
+                self._values = [numpy.concatenate(self._values)]
+                keys, values = self._keys[0], self._values[0]
+            else:
+                keys = numpy.empty(0)
+                values = numpy.empty(0, dtype=numpy.int64)
+            self._arrays = (keys, values, numpy.array(self._ends))
+        return self._arrays
+
+    def empty(self, states):
+        """
+        Return which of the given states have no value.
+
+        :param states: a NumPy array of state identifiers;
+        :return: a NumPy array of booleans, True for states without value.
+        """
+        ends = self._concatenate()[2]
+        return ends[states + 1] == ends[states]
+
+    def choose(self, states):
+        """
+        Return a random value for each of the given states, weighted by their
+        weights.
+
+        :param states: a NumPy array of identifiers of states with values;
+        :return: a NumPy array of the values chosen for each state.
+        """
+        keys, values, ends = self._concatenate()
+        x = states + numpy.random.random(len(states))
+        positions = numpy.searchsorted(keys, x, side="right")
+        positions = numpy.minimum(positions, ends[states + 1] - 1)
+        return values[positions]
+
+
+def alias_table(probabilities):
+    """
+    Return the alias table of the given probabilities (Vose's method).
+
+    :param probabilities: a list of probabilities, summing up to 1;
+    :return: a (thresholds, aliases) pair of lists, such that choosing i
+             uniformly, then keeping i with probability thresholds[i] and
+             choosing aliases[i] otherwise, chooses i with probability
+             probabilities[i].
+    """
+    count = len(probabilities)
+    scaled = [probability * count for probability in probabilities]
+    thresholds = [1.0] * count
+    aliases = list(range(count))
+    small = [index for index, value in enumerate(scaled) if value < 1]
+    large = [index for index, value in enumerate(scaled) if value >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        thresholds[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] += scaled[less] - 1
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+    return thresholds, aliases
+
+
+def random_sample(size, count):
+    """
+    Return count distinct random integers between 0 (included) and size
+    (excluded), in random order.
+
+    :param size: the number of integers to choose from; can be larger than
+                 the largest list;
+    :param count: the number of integers to choose; at most size;
+    :return: a list of count distinct integers of range(size).
+
+    The integers are chosen with Floyd's algorithm, in time and memory
+    proportional to count, whatever size.
+    """
+    chosen = set()
+    for last in range(size - count, size):
+        value = random.randint(0, last)
+        chosen.add(last if value in chosen else value)
+    chosen = list(chosen)
+    random.shuffle(chosen)
+    return chosen
+
+
+class LRUCache(object):
+    """
+    A mapping keeping at most a given number of items; when a new item is
+    added to a full cache, the least recently used item is discarded.
+    """
+
+    def __init__(self, size):
+        """
+        Create a new empty cache.
+
+        :param size: the maximum number of items of the cache; >= 1.
+        """
+        self.size = size
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Return the value of key, and mark key as recently used.
+
+        :param key: the key;
+        :param default: the value to return if key is not in this cache;
+        :return: the value of key if present, default otherwise.
+        """
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        """
+        Remove all the items of this cache.
+        """
+        self._items.clear()
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter is a compact set of words that can answer that a word is
+    in the set while it is not (a false positive), but never the converse.
+    The words are hashed into hashes positions of an array of size bits, and
+    a word is in the filter if all its positions are set.
+
+    The positions of a word are derived from the two halves of the MD5 digest
+    of its UTF-8 encoding (double hashing), such that filters saved by one
+    Python version can be read by another.
+    """
+
+    def __init__(self, size, hashes, bits=None, count=0):
+        """
+        Create a new Bloom filter.
+
+        :param size: the number of bits of the filter; >= 1;
+        :param hashes: the number of positions of each word; >= 1;
+        :param bits: if not None, the bits of the filter, as a sequence of
+                     (size + 7) // 8 bytes; otherwise, the filter is empty;
+        :param count: the number of words added to the filter.
+        """
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+        self.count = count
+
+    @classmethod
+    def from_words(cls, words, error_rate=0.01):
+        """
+        Return a Bloom filter of the given words, sized such that its false
+        positive rate is error_rate.
+
+        :param words: a collection of distinct words (such as a set, or the
+                      keys of a Counter);
+        :param error_rate: the probability that a word that is not in words
+                           is found in the filter; between 0 and 1;
+        :return: the filter of words.
+        """
+        capacity = max(len(words), 1)
+        size = max(int(math.ceil(-capacity * math.log(error_rate) /
+                                 math.log(2) ** 2)), 1)
+        hashes = max(int(round(size / capacity * math.log(2))), 1)
+        result = cls(size, hashes)
+        result.update(words)
+        return result
+
+    def _positions(self, word):
+        """
+        Return the positions of the bits of word.
+        """
+        first, second = struct.unpack(
+            "<QQ", hashlib.md5(word.encode("utf-8")).digest())
+        return [(first + index * second) % self.size
+                for index in range(self.hashes)]
+
+    def add(self, word):
+        """
+        Add word to this filter.
+
+        :param word: the word to add.
+        """
+        bits = self.bits
+        for position in self._positions(word):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, words):
+        """
+        Add the given words to this filter.
+
+        :param words: an iterable of words.
+        """
+        for word in words:
+            self.add(word)
+
+    def merge(self, other):
+        """
+        Add the words of other to this filter.
+
+        :param other: a filter of the same size and hashes as this one;
+        :raises ValueError: if other has not the same size and hashes.
+        """
+        if other.size != self.size or other.hashes != self.hashes:
+            raise ValueError("cannot merge filters of different sizes")
+        for index, byte in enumerate(other.bits):
+            if byte:
+                self.bits[index] |= byte
+        self.count += other.count
+
+    def copy(self):
+        """
+        Return a modifiable copy of this filter.
+        """
+        return type(self)(self.size, self.hashes, bytearray(self.bits),
+                          self.count)
+
+    def __contains__(self, word):
+        bits = self.bits
+        for position in self._positions(word):
+            if not bits[position >> 3] >> (position & 7) & 1:
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+
 def extract_words(lines):
     """
     Extract from the given iterable of lines the list of words.
@@ -81,10 +435,135 @@ def extract_words(lines):
     :return: a generator of words of lines.
     """
     for line in lines:
-        for word in re.findall(r"\w+", line):
+        for word in WORD.findall(line):
             yield word
 
 
+def extract_block_words(blocks, lower=False, normalization=None):
+    """
+    Extract from the given iterable of blocks of a text the list of words.
+    Unlike extract_words, the blocks can be arbitrary parts of the text, such
+    that a word can be split between two blocks; large blocks make the
+    extraction faster.
+
+    :param blocks: an iterable of consecutive strings of the text;
+    :param lower: whether to lowercase the words;
+    :param normalization: if not None, the Unicode normalization form of the
+                          words ("NFC", "NFKC", "NFD" or "NFKD");
+    :return: a generator of words of the blocks.
+    """
+    rest = ""
+    for block in blocks:
+        block = rest + block
+        if normalization is not None:
+            block = unicodedata.normalize(normalization, block)
+        if lower:
+            block = block.lower()
+        words = WORD.findall(block)
+        # The last word can continue in the next block
+        rest = words.pop() if WORD.match(block, len(block) - 1) else ""
+        for word in words:
+            yield word
+    if rest:
+        yield rest
+
+
+def text_blocks(text_file, block_size=BLOCK_SIZE):
+    """
+    Return a generator of the blocks of the given text file.
+
+    :param text_file: a file opened in text mode;
+    :param block_size: the number of characters of the blocks;
+    :return: a generator of the consecutive blocks of text_file.
+    """
+    while True:
+        block = text_file.read(block_size)
+        if not block:
+            break
+        yield block
+
+
+def file_chunks(path, count):
+    """
+    Split the file at path into count chunks of (roughly) equal size.
+
+    :param path: the path of the file;
+    :param count: the number of chunks; >= 1;
+    :return: a list of (start, end) pairs of byte offsets, covering the file.
+
+    The chunks do not take lines into account; use read_lines to read the
+    lines of a chunk.
+    """
+    size = os.path.getsize(path)
+    bounds = [size * index // count for index in range(count + 1)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if start < end]
+
+
+def read_lines(path, start, end, encoding=None):
+    """
+    Return a generator of the lines of the file at path that start in the
+    chunk between start (included) and end (excluded).
+
+    :param path: the path of the file;
+    :param start: the offset of the start of the chunk;
+    :param end: the offset of the end of the chunk;
+    :param encoding: the encoding of the file (default: UTF-8);
+    :return: a generator of the lines starting in the chunk.
+
+    Reading the consecutive chunks of file_chunks returns every line of the
+    file exactly once.
+    """
+    encoding = encoding if encoding is not None else "utf-8"
+    with open(path, "rb") as text_file:
+        if start > 0:
+            # Skip the line started in the previous chunk
+            text_file.seek(start - 1)
+            text_file.readline()
+        while text_file.tell() < end:
+            line = text_file.readline()
+            if not line:
+                break
+            yield line.decode(encoding)
+
+
+def read_blocks(path, start, end, encoding=None, block_size=BLOCK_SIZE):
+    """
+    Return a generator of the blocks of the lines of the file at path that
+    start in the chunk between start (included) and end (excluded).
+
+    :param path: the path of the file;
+    :param start: the offset of the start of the chunk;
+    :param end: the offset of the end of the chunk;
+    :param encoding: the encoding of the file (default: UTF-8);
+    :param block_size: the number of bytes of the blocks;
+    :return: a generator of the blocks of the lines starting in the chunk.
+
+    Like read_lines, reading the consecutive chunks of file_chunks returns
+    every line of the file exactly once; the blocks, however, are not split
+    at the end of lines.
+    """
+    decoder = codecs.getincrementaldecoder(encoding if encoding is not None
+                                           else "utf-8")()
+    with open(path, "rb") as text_file:
+        if start > 0:
+            # Skip the line started in the previous chunk
+            text_file.seek(start - 1)
+            text_file.readline()
+        position = text_file.tell()
+        block = b""
+        while position < end:
+            block = text_file.read(min(block_size, end - position))
+            if not block:
+                break
+            position += len(block)
+            yield decoder.decode(block)
+        if block and not block.endswith(b"\n"):
+            # Finish the last line started in the chunk
+            yield decoder.decode(text_file.readline())
+        yield decoder.decode(b"", True)
+
+
 class GenerationError(Exception):
     """
     A problem occurred during random word generation.
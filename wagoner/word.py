@@ -5,41 +5,221 @@ The word module generate, from a given table, a (set of) random words.
 """
 
 import argparse
+from collections import Counter
+import multiprocessing
 import pickle
+import random
+import sys
 from wagoner.utils import *
-from wagoner.table import Table
-from wagoner.tree import Tree
+from wagoner import stats
+from wagoner.table import Table, MixedTable
+from wagoner.tree import Tree, MultiTree, LazyTree
+from wagoner import storage
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+# The content the words are generated from, set in each process
+_content = None
+
+# The number of successive batches of corpus words after which the
+# generation of novel words fails
+NOVEL_ATTEMPTS = 100
+
+
+def _initialize(content):
+    """
+    Set the content the words of this process are generated from.
+
+    :param content: the table or tree to generate words from.
+    """
+    global _content
+    _content = content
+
+
+def _generate_chunk(chunk):
+    """
+    Return the words of the given chunk, generated from the content of this
+    process.
+
+    :param chunk: an (index, count, seed, length, prefix, start, end, flatten,
+                  novel) tuple, where index is the index of the chunk, count
+                  the number of words of the chunk, seed the seed of the
+                  generation (or None) and novel whether the words of the
+                  corpus are rejected;
+    :return: the words of the chunk, one per line.
+    :raises GenerationError: if novel is True and no novel word is found in
+                             NOVEL_ATTEMPTS successive batches of words.
+    """
+    index, count, seed, length, prefix, start, end, flatten, novel = chunk
+    if seed is not None:
+        # Each chunk has its own stream, whatever process generates it
+        random.seed("%d-%d" % (seed, index))
+        if numpy is not None:
+            numpy.random.seed(random.getrandbits(32))
+    words = []
+    attempts = 0
+    while len(words) < count:
+        batch = _content.random_words(count - len(words), length,
+                                      prefix=prefix, start=start, end=end,
+                                      flatten=flatten)
+        if novel:
+            batch = [word for word in batch if word not in _content.corpus]
+            attempts = 0 if batch else attempts + 1
+            if attempts == NOVEL_ATTEMPTS:
+                raise GenerationError("no word outside of the corpus can be "
+                                      "generated")
+        words.extend(batch)
+    return "".join(word + "\n" for word in words)
+
+
+def generate(content, count, length, prefix=0, start=False, end=False,
+             flatten=False, jobs=1, seed=None, ordered=True, chunk_size=1000,
+             novel=False):
+    """
+    Generate count random words from content, by chunks of words.
+
+    :param content: the table or tree to generate words from;
+    :param count: the number of words;
+    :param length: the length of the words, or None for words of random
+                   lengths from a multi-tree;
+    :param prefix: if greater than 0, the length of the prefixes used for
+                   choosing the next character;
+    :param start: whether the words must start as in the content;
+    :param end: whether the words must end as in the content;
+    :param flatten: whether the weights are flattened;
+    :param jobs: the number of processes generating the words; >= 1;
+    :param seed: if not None, the seed of the generation;
+    :param ordered: whether the chunks are yielded in order; otherwise, they
+                    are yielded as soon as they are generated;
+    :param chunk_size: the number of words of a chunk;
+    :param novel: whether to reject the words found in the corpus filter of
+                  content (content.corpus), and generate others instead;
+    :return: a generator of the chunks, as strings of words, one per line.
+    :raises ValueError: if novel is True and content has no corpus filter.
+
+    Each chunk is generated with its own random stream, derived from seed and
+    the index of the chunk; the ordered words generated with the same seed
+    are thus the same whatever the number of processes.
+    """
+    if novel and getattr(content, "corpus", None) is None:
+        raise ValueError("the content has no corpus filter")
+    chunks = ((index, min(chunk_size, count - first), seed, length, prefix,
+               start, end, flatten, novel)
+              for index, first in enumerate(range(0, count, chunk_size)))
+    if jobs <= 1:
+        for chunk in chunks:
+            # The content is set again for each chunk, as several generators
+            # of this process can be interleaved (such as by the server)
+            _initialize(content)
+            yield _generate_chunk(chunk)
+        return
+    # Forked processes inherit content; otherwise, it is pickled once per
+    # process (memory-mapped contents are pickled as their path)
+    pool = multiprocessing.Pool(jobs, _initialize, (content,))
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for words in imap(_generate_chunk, chunks):
+            yield words
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def load_content(path, prefix=0, flatten=False):
+    """
+    Load the table or tree at path, saved in binary format or pickled, or
+    build the table of the text at path.
+
+    :param path: the path of the content;
+    :param prefix: if greater than 0, the maximum length of the prefixes
+                   stored in the table of a text;
+    :param flatten: whether to flatten the table of a text;
+    :return: the loaded table or tree.
+    """
+    if storage.is_binary(path):
+        return storage.load(path)
+    try:
+        with open(path, "rb") as content_file:
+            return pickle.load(content_file)
+    except pickle.UnpicklingError:
+        with open(path, "r") as text_file:
+            words = Counter(extract_block_words(text_blocks(text_file)))
+            return Table.from_words(words, prefix=prefix, flatten=flatten)
+
+
+def weighted_path(value):
+    """
+    Return the (path, weight) pair of value, of the form path=weight.
+
+    :param value: the string to parse;
+    :return: the path and the weight of value.
+    :raises argparse.ArgumentTypeError: if value is not of the form
+                                        path=weight, with a positive weight.
+    """
+    path, separator, weight = value.rpartition("=")
+    try:
+        weight = float(weight)
+    except ValueError:
+        weight = None
+    if not separator or not path or weight is None or weight <= 0:
+        raise argparse.ArgumentTypeError("%s is not of the form path=weight"
+                                         % value)
+    return path, weight
 
 
 def process_arguments():
     """
     Process the command line arguments. The arguments are:
      * the table to generate random from;
-     * -l (or --length) for the length of generated words (default: 10);
+     * -l (or --length) for the length of generated words (default: 10 for
+       tables, random lengths for multi-trees);
      * -p (or --prefix) for the maximum of prefixes to consider (default: 0);
      * -c (or --count) for the number of words to generate (default: 10);
      * -s (or --start) for generating only words starting in table;
      * -e (or --end) for generating only words ending in table;
-     * -f (or --flatten) if the table must be flattened before generation.
+     * -f (or --flatten) if the table must be flattened before generation;
+     * -m (or --mix) for a table to mix with the content, as path=weight
+       (can be repeated);
+     * -w (or --weight) for the weight of the content in the mix
+       (default: 1);
+     * --max-nodes for the maximum number of tree nodes kept in memory when
+       generating ending words from a table (default: 1000000);
+     * -j (or --jobs) for the number of processes generating words
+       (default: 1);
+     * --seed for the seed of the generation (default: random);
+     * --unordered if the words can be printed in any order;
+     * -u (or --unique) for generating distinct words from a tree;
+     * -n (or --novel) for rejecting the words of the corpus;
+     * --uniform for drawing the distinct words uniformly;
+     * --stats if statistics must be printed (on stderr).
     """
     parser = argparse.ArgumentParser(description="Generate random words from "
                                                  "the given content",
                                      epilog="This script can generate random"
                                             "words from tables, trees or "
-                                            "texts. If a tree is given, "
+                                            "texts; tables and trees can be "
+                                            "pickled or saved in binary "
+                                            "format. If a tree is given, "
                                             "the length of the generated "
-                                            "words depend on the tree. If a "
+                                            "words depend on the tree; "
+                                            "multi-trees generate words of "
+                                            "random lengths, unless --length "
+                                            "is given. If a "
                                             "table is given, the table is "
-                                            "used to generate words, except "
-                                            "if --end option is given. If a "
-                                            "text is given, "
+                                            "used to generate words; if "
+                                            "--end option is given, the "
+                                            "corresponding tree is explored "
+                                            "lazily. If a text is given, "
                                             "the corresponding table is "
-                                            "built, and also the tree if "
-                                            "needed.")
+                                            "built first.")
     parser.add_argument("content", help="the content")
-    parser.add_argument("--length", "-l", type=nonzero_natural, default=10,
+    parser.add_argument("--length", "-l", type=nonzero_natural, default=None,
                         dest="length", help="the length of generated words "
-                                            "(default: 10)")
+                                            "(default: 10 for tables, random "
+                                            "lengths for multi-trees)")
     parser.add_argument("--prefix", "-p", type=natural, default=0,
                         dest="prefix", help="if not 0, the maximum length of "
                                             "prefixes to consider when "
@@ -54,22 +234,111 @@ def process_arguments():
                         dest="end", help="only ending words")
     parser.add_argument("--flatten", "-f", action="store_true", default=False,
                         dest="flatten", help="flatten the table")
+    parser.add_argument("--mix", "-m", type=weighted_path, action="append",
+                        default=[], dest="mix",
+                        help="a table to mix with the content, as "
+                             "path=weight; the words are generated from the "
+                             "mixture of the tables, each table having the "
+                             "given share of the choices (can be repeated)")
+    parser.add_argument("--weight", "-w", type=float, default=1,
+                        dest="weight", help="the weight of the content in "
+                                            "the mix (default: 1)")
+    parser.add_argument("--max-nodes", type=nonzero_natural, default=1000000,
+                        dest="max_nodes", help="the maximum number of tree "
+                                               "nodes kept in memory when "
+                                               "generating ending words from "
+                                               "a table (default: 1000000)")
+    parser.add_argument("--jobs", "-j", type=nonzero_natural, default=1,
+                        dest="jobs", help="the number of processes "
+                                          "generating words (default: 1)")
+    parser.add_argument("--seed", type=natural, default=None, dest="seed",
+                        help="the seed of the generation; the same seed "
+                             "gives the same words, whatever the number of "
+                             "processes (default: random)")
+    parser.add_argument("--unique", "-u", action="store_true", default=False,
+                        dest="unique", help="generate distinct words (only "
+                                            "from trees)")
+    parser.add_argument("--novel", "-n", action="store_true", default=False,
+                        dest="novel", help="reject the words of the corpus, "
+                                           "with the corpus filter of the "
+                                           "table or tree (see the --filter "
+                                           "option of wagoner.table)")
+    parser.add_argument("--uniform", action="store_true", default=False,
+                        dest="uniform", help="with --unique, draw the words "
+                                             "uniformly instead of with the "
+                                             "weights of the tree")
+    parser.add_argument("--unordered", action="store_true", default=False,
+                        dest="unordered", help="print the words as soon as "
+                                               "they are generated, in any "
+                                               "order")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        dest="stats", help="print statistics about the "
+                                           "phases of the generation on "
+                                           "stderr")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = process_arguments()
-    try:
-        with open(args.content, "rb") as content_file:
-            content = pickle.load(content_file)
-    except pickle.UnpicklingError:
-        with open(args.content, "r") as text_file:
-            content = Table.from_words(extract_words(text_file),
-                                       prefix=args.prefix,
-                                       flatten=args.flatten)
+    if args.stats:
+        statistics = stats.Statistics()
+        stats.register(statistics)
+
+    with stats.phase("load content"):
+        content = load_content(args.content, prefix=args.prefix,
+                               flatten=args.flatten)
+        if args.mix:
+            tables = [content] + [load_content(path, prefix=args.prefix,
+                                               flatten=args.flatten)
+                                  for path, _ in args.mix]
+            if not all(isinstance(table, Table) for table in tables):
+                sys.stderr.write("[ERROR] Only tables can be mixed.\n")
+                sys.exit(1)
+            if args.weight <= 0:
+                sys.stderr.write("[ERROR] The weight of the content must be "
+                                 "positive.\n")
+                sys.exit(1)
+            content = MixedTable(tables, [args.weight] +
+                                 [weight for _, weight in args.mix])
+    if isinstance(content, MultiTree):
+        if args.length is not None and args.length not in content.lengths:
+            sys.stderr.write("[ERROR] The multi-tree only generates words of "
+                             "lengths %s.\n" %
+                             ", ".join(str(length)
+                                       for length in content.lengths))
+            sys.exit(1)
+    elif args.length is None:
+        args.length = 10
     if args.end and isinstance(content, Table):
-        content = Tree.from_table(content, args.length, prefix=args.prefix,
-                                  flatten=args.flatten)
-    for _ in range(args.count):
-        print(content.random_word(args.length, prefix=args.prefix,
-                                  start=args.start, end=args.end,
-                                  flatten=args.flatten))
+        content = LazyTree(content, args.length, prefix=args.prefix,
+                           flatten=args.flatten, max_nodes=args.max_nodes)
+    if args.unique and not isinstance(content, Tree):
+        sys.stderr.write("[ERROR] Distinct words can only be generated from "
+                         "trees.\n")
+        sys.exit(1)
+    if args.novel and args.unique:
+        sys.stderr.write("[ERROR] Distinct words cannot be novel words.\n")
+        sys.exit(1)
+    if args.novel and getattr(content, "corpus", None) is None:
+        sys.stderr.write("[ERROR] The content has no corpus filter.\n")
+        sys.exit(1)
+    with stats.phase("generate words"):
+        if args.unique:
+            if args.seed is not None:
+                random.seed(args.seed)
+            try:
+                words = content.sample_distinct(args.count,
+                                                weighted=not args.uniform)
+            except ValueError as error:
+                sys.stderr.write("[ERROR] %s.\n" % error)
+                sys.exit(1)
+            sys.stdout.write("".join(word + "\n" for word in words))
+        else:
+            for words in generate(content, args.count, args.length,
+                                  prefix=args.prefix, start=args.start,
+                                  end=args.end, flatten=args.flatten,
+                                  jobs=args.jobs, seed=args.seed,
+                                  ordered=not args.unordered,
+                                  novel=args.novel):
+                sys.stdout.write(words)
+    if args.stats:
+        sys.stderr.write(statistics.report() + "\n")